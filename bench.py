@@ -0,0 +1,348 @@
+#! /usr/bin/env python3
+##
+import argparse
+import json
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from loguru import logger
+
+import bot
+
+HOME = "home.bench"
+LEMMYVERSE = "lemmyverse.net"
+LANGUAGES = [{"id": 0, "code": "und"}, {"id": 37, "code": "en"}, {"id": 39, "code": "de"}]
+
+
+class MockFediverse:
+    def __init__(self, instances, pages, page_size, latency, error_rate, seed):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.errors = 0
+
+        # Generate remote instances, each with communities sorted by activity
+        self.instances = {}
+        for i in range(instances):
+            communities = []
+            for j in range(pages * page_size):
+                communities.append({
+                    "community": {
+                        "id": j + 1,
+                        "name": f"community{j}",
+                        "actor_id": f"https://instance{i}.bench/c/community{j}",
+                        "nsfw": j % 17 == 0,
+                    },
+                    "counts": {"users_active_half_year": max(0, 10000 // (j + 1) - i)},
+                    "discussion_languages": [[0], [37], [39], [0, 37]][j % 4],
+                })
+            communities.sort(key=lambda c: c["counts"]["users_active_half_year"], reverse=True)
+            self.instances[f"instance{i}.bench"] = communities
+
+        # Home instance state
+        self.home_ids = {}
+        self.subscribed = set()
+
+        # Communities inserted mid-list, and those the home instance currently fails to resolve
+        self.inserted = set()
+        self.failing = set()
+
+    def insert(self, host, index):
+        # Add a community at index, sharing the activity of its neighbour to keep the list sorted
+        communities = self.instances[host]
+        index = min(index, len(communities) - 1)
+        actor_id = f"https://{host}/c/inserted{len(self.inserted)}"
+        with self.lock:
+            communities.insert(index, {
+                "community": {
+                    "id": len(communities) + 1,
+                    "name": f"inserted{len(self.inserted)}",
+                    "actor_id": actor_id,
+                    "nsfw": False,
+                },
+                "counts": dict(communities[index]["counts"]),
+                "discussion_languages": [0, 37],
+            })
+            self.inserted.add(actor_id)
+        return actor_id
+
+    def handle(self, host, method, path, query, body):
+        # Inject latency and errors
+        if self.latency > 0:
+            time.sleep(self.random.uniform(0.5, 1.5) * self.latency)
+        with self.lock:
+            self.requests[f"{host if host in (HOME, LEMMYVERSE) else 'remote'} {path}"] += 1
+
+            # Login is not retried by the bot, so keep it reliable
+            if path != "/api/v3/user/login" and self.random.random() < self.error_rate:
+                self.errors += 1
+                return 500, {"error": "internal_server_error"}
+
+        if host == LEMMYVERSE:
+            return self.handle_lemmyverse(path)
+        if host == HOME:
+            return self.handle_home(method, path, query, body)
+        if host in self.instances:
+            return self.handle_remote(host, path, query)
+        return 404, {"error": "unknown_host"}
+
+    def handle_lemmyverse(self, path):
+        # Serve 50 instances per page, and a html page once past the last one
+        page = int(path.rsplit("/", 1)[-1].split(".")[0])
+        hosts = list(self.instances)[page * 50:(page + 1) * 50]
+        if len(hosts) == 0:
+            return 200, "<html></html>"
+        return 200, [
+            {
+                "baseurl": host,
+                "score": len(self.instances) - i,
+                "usage": {"users": {"activeHalfyear": 10000 // (i + 1)}},
+            }
+            for i, host in enumerate(hosts, page * 50)
+        ]
+
+    def handle_remote(self, host, path, query):
+        communities = self.instances[host]
+        if path == "/api/v3/site":
+            return 200, {"all_languages": LANGUAGES}
+        if path == "/api/v3/community/list":
+            limit = int(query.get("limit", 10))
+            page = int(query.get("page", 1))
+            return 200, {
+                "communities": [
+                    {"community": c["community"], "counts": c["counts"]}
+                    for c in communities[(page - 1) * limit:page * limit]
+                ]
+            }
+        if path == "/api/v3/community":
+            for c in communities:
+                if c["community"]["name"] == query.get("name"):
+                    return 200, {"community_view": c, "discussion_languages": c["discussion_languages"]}
+            return 404, {"error": "couldnt_find_community"}
+        return 404, {"error": "not_found"}
+
+    def handle_home(self, method, path, query, body):
+        if path == "/api/v3/user/login":
+            return 200, {"jwt": "bench"}
+        if path == "/api/v3/resolve_object":
+            if query["q"] in self.failing:
+                return 500, {"error": "internal_server_error"}
+            with self.lock:
+                id = self.home_ids.setdefault(query["q"], len(self.home_ids) + 1)
+            return 200, {"community": {"community": {"id": id, "actor_id": query["q"]}}}
+        if path == "/api/v3/community/follow":
+            with self.lock:
+                actor_id = next((a for a, id in self.home_ids.items() if id == body["community_id"]), None)
+                if body["follow"]:
+                    self.subscribed.add(actor_id)
+                else:
+                    self.subscribed.discard(actor_id)
+            return 200, {"community_view": {}}
+        if path == "/api/v3/community/list":
+            with self.lock:
+                actor_ids = sorted(self.subscribed if query.get("type_") == "Subscribed" else self.home_ids)
+            limit = int(query.get("limit", 10))
+            page = int(query.get("page", 1))
+            return 200, {
+                "communities": [
+                    {
+                        "community": {"id": self.home_ids[a], "actor_id": a},
+                        "subscribed": "Subscribed" if a in self.subscribed else "NotSubscribed",
+                    }
+                    for a in actor_ids[(page - 1) * limit:page * limit]
+                ]
+            }
+        return 404, {"error": "not_found"}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.respond(None)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.respond(json.loads(self.rfile.read(length)) if length > 0 else None)
+
+    def respond(self, body):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        status, data = self.server.fediverse.handle(self.headers["Host"], self.command, url.path, query, body)
+
+        # Strings are served as html, everything else as json
+        content = data.encode() if isinstance(data, str) else json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html" if isinstance(data, str) else "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class MockTransport(bot.Transport):
+    def __init__(self, port, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.port = port
+
+    def url(self, host, path):
+        return f"http://127.0.0.1:{self.port}{path}"
+
+    def send(self, method, host, path, auth, headers=None, **kwargs):
+        # Route every host to the mock server by Host header
+        return super().send(method, host, path, auth, headers={**(headers or {}), "Host": host}, **kwargs)
+
+
+def mutate(b, fediverse):
+    # Insert a community on a page the next incremental crawl skips, falling back to mid-list, and
+    # fail resolving it during this phase. It is only found again through the retried work.
+    for host, communities in fediverse.instances.items():
+        scan = b.db.get_instance_scan(host)
+        pages = [] if scan is None else [int(p) for p in scan["pages"] if not b.should_fetch_page(scan, int(p))]
+        index = (min(pages) - 1) * b.PAGE_LIMIT + b.PAGE_LIMIT // 2 if pages else len(communities) // 2
+        fediverse.failing.add(fediverse.insert(host, index))
+    try:
+        b.start()
+    finally:
+        fediverse.failing.clear()
+
+
+def run(name, fn, fediverse):
+    # Measure wall time, request count and peak memory of a single phase
+    fediverse.requests.clear()
+    fediverse.errors = 0
+    tracemalloc.start()
+    start = time.monotonic()
+    fn()
+    elapsed = time.monotonic() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    requests = sum(fediverse.requests.values())
+    return {
+        "phase": name,
+        "wall_time": round(elapsed, 3),
+        "requests": requests,
+        "requests_per_second": round(requests / elapsed, 1) if elapsed > 0 else 0,
+        "peak_memory_mib": round(peak / 2 ** 20, 2),
+        "errors": fediverse.errors,
+        "missing": len(fediverse.inserted - set(fediverse.home_ids)),
+        "endpoints": dict(fediverse.requests.most_common()),
+    }
+
+
+def main():
+    # Get and parse arguments
+    parser = argparse.ArgumentParser(
+        description="lemmy-subscriber benchmark", formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("-v", "--verbose", action="count", default=0)
+    parser.add_argument("--instances", type=int, default=20, help="number of mock remote instances")
+    parser.add_argument("--pages", type=int, default=4, help="community pages of 50 per mock instance")
+    parser.add_argument("--latency", type=float, default=0.01, help="mean injected latency per request in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with HTTP 500")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for latency and error injection")
+    parser.add_argument(
+        "--phases",
+        type=str,
+        default="start,start,reset",
+        help="comma-separated phases to run, mutate inserts communities mid-list that fail to resolve once",
+    )
+    parser.add_argument("--json", action="store_true", default=False, help="print results as json")
+
+    parser.add_argument("--threshold-add", type=int, default=50)
+    parser.add_argument("--threshold-subscribe", type=int, default=500)
+    parser.add_argument("--lang-codes", type=str)
+    parser.add_argument("--crawl-workers", type=int, default=8)
+    parser.add_argument("--crawl-host-workers", type=int, default=2)
+    parser.add_argument("--resolve-workers", type=int, default=2)
+    parser.add_argument("--subscribe-workers", type=int, default=2)
+    parser.add_argument("--rate-limit", type=float, default=1000.0)
+    args = parser.parse_args()
+
+    # Verbosity configuration
+    logger.remove()
+    logger.add(sys.stderr, level=["WARNING", "INFO", "DEBUG"][min(args.verbose, 2)])
+
+    # Start mock server
+    fediverse = MockFediverse(args.instances, args.pages, bot.Bot.PAGE_LIMIT, args.latency, args.error_rate, args.seed)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    server.daemon_threads = True
+    server.fediverse = fediverse
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Create bot against a fresh database, routed to the mock server
+    directory = tempfile.TemporaryDirectory()
+    database = f"{directory.name}/database.db"
+    b = bot.Bot(
+        domain=HOME,
+        username="bench",
+        password="bench",
+        threshold_resolve=args.threshold_add,
+        threshold_subscribe=args.threshold_subscribe,
+        daemon=False,
+        daemon_delay=0,
+        lang_codes=args.lang_codes.split(",") if args.lang_codes else None,
+        database=database,
+        crawl_workers=args.crawl_workers,
+        crawl_host_workers=args.crawl_host_workers,
+        resolve_workers=args.resolve_workers,
+        subscribe_workers=args.subscribe_workers,
+        rate_limit=args.rate_limit,
+    )
+    b.http = MockTransport(
+        server.server_address[1],
+        args.crawl_host_workers,
+        login=b.retrieve_jwt,
+        metrics=b.metrics,
+        pool_connections=2 * args.crawl_workers,
+    )
+    b.http.mount(HOME, args.resolve_workers + args.subscribe_workers + 1)
+
+    # Retry failed work on the next phase instead of backing off for minutes
+    for q in (b.rq, b.sq):
+        q.retry_delay = 0
+
+    # Run phases
+    results = []
+    for phase in args.phases.split(","):
+        phases = {"start": b.start, "mutate": lambda: mutate(b, fediverse), "reset": b.reset}
+        results.append(run(phase, phases[phase], fediverse))
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Remove database, including its WAL files
+    b.db.conn.close()
+    directory.cleanup()
+
+    if args.json:
+        print(json.dumps({"results": results, "max_rss_kib": max_rss}, indent=2))
+        return
+
+    # Print summary
+    print(
+        f"{'phase':<8} {'wall (s)':>10} {'requests':>10} {'req/s':>10} {'peak (MiB)':>12} {'errors':>8} {'missing':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['phase']:<8} {result['wall_time']:>10} {result['requests']:>10} "
+            f"{result['requests_per_second']:>10} {result['peak_memory_mib']:>12} {result['errors']:>8} "
+            f"{result['missing']:>8}"
+        )
+    print(f"max rss: {max_rss / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,62 @@
 #! /usr/bin/env python3
 ##
 import argparse
+import bisect
+import concurrent.futures
+import contextlib
+import cProfile
+import dbm
+import email.utils
 import functools
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import math
 import os
-import queue
+import pstats
 import random
 import re
 import shelve
+import socket
+import sqlite3
 import sys
 import threading
 import time
-from typing import Tuple
+from typing import List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
 from loguru import logger
 from retry import retry
+from retry.api import retry_call
 
 # Prepare logger
 logger.remove()
 logger.add(sys.stdout, level="INFO")
 
-# Set default timeout
-timeout = 15
+# Negotiate brotli only if a decoder is available
+try:
+    import brotli  # noqa: F401
 
-# Prepare global session and timeout
-session = requests.Session()
-session.request = functools.partial(session.request, timeout=timeout)
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# Parse json with orjson if available, it decodes bytes directly and is several times faster
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Metrics endpoint is only available if prometheus_client is installed
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
 
 
 class ResolveException(Exception):
@@ -37,7 +67,1257 @@ class SubscribeException(Exception):
     pass
 
 
+class RateLimitException(Exception):
+    pass
+
+
+class ListingException(Exception):
+    pass
+
+
+class CrawlException(Exception):
+    pass
+
+
+class CommunityRecord:
+    # Fields of community views used by the crawler, without keeping the parsed views around
+    __slots__ = ("id", "name", "actor_id", "nsfw", "users_active_half_year")
+
+    def __init__(self, id, name, actor_id, nsfw, users_active_half_year):
+        self.id = id
+        self.name = name
+        self.actor_id = actor_id
+        self.nsfw = nsfw
+        self.users_active_half_year = users_active_half_year
+
+    @classmethod
+    def parse_list(cls, content) -> Optional[List["CommunityRecord"]]:
+        # Error responses come without communities
+        data = json_loads(content)
+        if not isinstance(data, dict) or "communities" not in data:
+            return None
+        return [
+            cls(
+                c["community"]["id"],
+                c["community"]["name"],
+                c["community"]["actor_id"],
+                c["community"]["nsfw"],
+                c["counts"]["users_active_half_year"],
+            )
+            for c in data["communities"]
+        ]
+
+
+class ShardStore:
+    # Shared state of shard nodes, their leases and their persisted work queues. Database is the
+    # local implementation for processes on one host, sharding across hosts needs a store all of
+    # them can reach, implementing the same methods.
+
+    def heartbeat(self, node):
+        raise NotImplementedError
+
+    def get_nodes(self, since) -> list:
+        raise NotImplementedError
+
+    def acquire_lease(self, key, node, expires_at) -> bool:
+        raise NotImplementedError
+
+    def release_lease(self, key, node):
+        raise NotImplementedError
+
+    def clear_expired_leases(self):
+        raise NotImplementedError
+
+    def add_work(self, kind, actor_id, priority, node=""):
+        raise NotImplementedError
+
+    def remove_work(self, kind, actor_id, node=""):
+        raise NotImplementedError
+
+    def defer_work(self, kind, actor_id, delay, max_attempts, node=""):
+        raise NotImplementedError
+
+    def get_work(self, kind, node="", limit=-1):
+        raise NotImplementedError
+
+    def count_work(self, kind, node=""):
+        raise NotImplementedError
+
+    def adopt_work(self, node, nodes):
+        raise NotImplementedError
+
+
+class Database(ShardStore):
+    VERSION = 4
+
+    STATE_RESOLVED = 1
+    STATE_SUBSCRIBED = 2
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS communities (
+            actor_id TEXT PRIMARY KEY,
+            id INTEGER,
+            state INTEGER NOT NULL,
+            instance TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS communities_state ON communities (state);
+        CREATE INDEX IF NOT EXISTS communities_instance ON communities (instance);
+
+        CREATE TABLE IF NOT EXISTS statistics (
+            state INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO statistics (state, count) VALUES (1, 0), (2, 0);
+
+        CREATE TABLE IF NOT EXISTS cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS work (
+            kind TEXT NOT NULL,
+            actor_id TEXT NOT NULL,
+            priority INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            node TEXT NOT NULL DEFAULT '',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            retry_after REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (kind, actor_id, node)
+        );
+
+        CREATE TABLE IF NOT EXISTS crawl_progress (
+            instance TEXT PRIMARY KEY,
+            page INTEGER NOT NULL,
+            finished INTEGER NOT NULL,
+            updated_at REAL NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS instance_scans (
+            instance TEXT PRIMARY KEY,
+            scan TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS instance_schedule (
+            instance TEXT PRIMARY KEY,
+            next_visit REAL NOT NULL,
+            interval REAL NOT NULL,
+            yield_rate REAL NOT NULL,
+            failures INTEGER NOT NULL,
+            last_visit REAL NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS instance_health (
+            instance TEXT PRIMARY KEY,
+            latency REAL NOT NULL,
+            error_rate REAL NOT NULL,
+            failures INTEGER NOT NULL,
+            opened_until REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS nodes (
+            node TEXT PRIMARY KEY,
+            heartbeat REAL NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS leases (
+            key TEXT PRIMARY KEY,
+            node TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+
+        CREATE TRIGGER IF NOT EXISTS communities_insert AFTER INSERT ON communities BEGIN
+            UPDATE statistics SET count = count + 1 WHERE state = NEW.state;
+        END;
+        CREATE TRIGGER IF NOT EXISTS communities_update AFTER UPDATE OF state ON communities
+        WHEN OLD.state != NEW.state BEGIN
+            UPDATE statistics SET count = count - 1 WHERE state = OLD.state;
+            UPDATE statistics SET count = count + 1 WHERE state = NEW.state;
+        END;
+        CREATE TRIGGER IF NOT EXISTS communities_delete AFTER DELETE ON communities BEGIN
+            UPDATE statistics SET count = count - 1 WHERE state = OLD.state;
+        END;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+
+        # Read legacy shelve database before it gets replaced
+        legacy = self.read_shelve(path)
+
+        # Open database, shared between all threads behind a lock
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA busy_timeout = 30000")
+        with self.lock:
+            self.conn.executescript(self.SCHEMA)
+            self.migrate_work()
+            self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', ?)", (self.VERSION,))
+            self.conn.execute("UPDATE meta SET value = ? WHERE key = 'version'", (self.VERSION,))
+
+        # Drop expired cache entries
+        self.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+
+        # Import legacy entries
+        if legacy is not None:
+            self.migrate_shelve(legacy)
+
+    def migrate_work(self):
+        # Work of version 2 databases is not owned by any node, rebuild table with node in primary key
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(work)")]
+        if "node" not in columns:
+            self.conn.execute("ALTER TABLE work RENAME TO work_old")
+            self.conn.executescript(self.SCHEMA)
+            self.conn.execute(
+                "INSERT INTO work (kind, actor_id, priority, created_at) "
+                "SELECT kind, actor_id, priority, created_at FROM work_old"
+            )
+            self.conn.execute("DROP TABLE work_old")
+            return
+
+        # Work of version 3 databases has no retry backoff
+        if "retry_after" not in columns:
+            self.conn.execute("ALTER TABLE work ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("ALTER TABLE work ADD COLUMN retry_after REAL NOT NULL DEFAULT 0")
+
+    @staticmethod
+    def read_shelve(path):
+        # Only migrate if a shelve database exists at path
+        if not dbm.whichdb(path):
+            return None
+
+        # Python 3.13+ recognises any SQLite file as dbm.sqlite3, only shelves of that backend consist of a Dict table
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                header = f.read(16)
+            if header == b"SQLite format 3\0":
+                conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+                try:
+                    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                finally:
+                    conn.close()
+                if tables != {"Dict"}:
+                    return None
+
+        # Load all entries into memory
+        with shelve.open(path, flag="r") as db:
+            entries = dict(db.items())
+
+        # Move legacy files out of the way
+        for suffix in ["", ".db", ".dat", ".dir", ".bak", ".pag"]:
+            if os.path.exists(path + suffix):
+                os.rename(path + suffix, path + suffix + ".old")
+
+        logger.info(f"loaded {len(entries)} entries from legacy shelve database '{path}'")
+        return entries
+
+    def migrate_shelve(self, entries):
+        # Legacy format stores community id for resolved, and -1 for subscribed communities
+        now = time.time()
+        rows = []
+        for actor_id, value in entries.items():
+            if actor_id == "_version":
+                continue
+            if value == -1:
+                rows.append((actor_id, None, self.STATE_SUBSCRIBED, self.get_instance(actor_id), now, now))
+            else:
+                rows.append((actor_id, value, self.STATE_RESOLVED, self.get_instance(actor_id), now, now))
+
+        # Insert all rows in a single transaction
+        with self.transaction():
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO communities (actor_id, id, state, instance, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        logger.success(f"migrated {len(rows)} communities from legacy shelve database")
+
+    @staticmethod
+    def get_instance(actor_id):
+        return actor_id.split("/")[2]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            return self.conn.execute(sql, parameters).fetchall()
+
+    def get_state(self, actor_id):
+        rows = self.execute("SELECT state FROM communities WHERE actor_id = ?", (actor_id,))
+        return rows[0][0] if rows else None
+
+    def get_id(self, actor_id):
+        rows = self.execute("SELECT id FROM communities WHERE actor_id = ?", (actor_id,))
+        return rows[0][0] if rows else None
+
+    def is_known(self, actor_id):
+        return self.get_state(actor_id) is not None
+
+    def is_subscribed(self, actor_id):
+        return self.get_state(actor_id) == self.STATE_SUBSCRIBED
+
+    def set_state(self, actor_id, id, state):
+        now = time.time()
+        self.execute(
+            "INSERT INTO communities (actor_id, id, state, instance, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (actor_id) DO UPDATE SET "
+            "id = COALESCE(excluded.id, id), state = excluded.state, updated_at = excluded.updated_at",
+            (actor_id, id, state, self.get_instance(actor_id), now, now),
+        )
+
+    def set_resolved(self, actor_id, id):
+        self.set_state(actor_id, id, self.STATE_RESOLVED)
+
+    def set_subscribed(self, actor_id, id=None):
+        self.set_state(actor_id, id, self.STATE_SUBSCRIBED)
+
+    def cache_get(self, key):
+        rows = self.execute("SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, time.time()))
+        return json.loads(rows[0][0]) if rows else None
+
+    def cache_set(self, key, value, ttl):
+        self.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time() + ttl),
+        )
+
+    def add_work(self, kind, actor_id, priority, node=""):
+        self.execute(
+            "INSERT INTO work (kind, actor_id, priority, created_at, node) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (kind, actor_id, node) DO UPDATE SET priority = MAX(priority, excluded.priority)",
+            (kind, actor_id, priority, time.time(), node),
+        )
+
+    def remove_work(self, kind, actor_id, node=""):
+        self.execute("DELETE FROM work WHERE kind = ? AND actor_id = ? AND node = ?", (kind, actor_id, node))
+
+    def defer_work(self, kind, actor_id, delay, max_attempts, node=""):
+        # Back off exponentially from failed attempts, dropping work that keeps failing
+        with self.transaction():
+            self.execute(
+                "UPDATE work SET attempts = attempts + 1, retry_after = ? + ? * (1 << MIN(attempts, 16)) "
+                "WHERE kind = ? AND actor_id = ? AND node = ?",
+                (time.time(), delay, kind, actor_id, node),
+            )
+            self.execute(
+                "DELETE FROM work WHERE kind = ? AND actor_id = ? AND node = ? AND attempts >= ?",
+                (kind, actor_id, node, max_attempts),
+            )
+
+    def get_work(self, kind, node="", limit=-1):
+        # Only work that is not backing off from a failed attempt
+        return self.execute(
+            "SELECT actor_id, priority FROM work WHERE kind = ? AND node = ? AND retry_after <= ? "
+            "ORDER BY priority DESC LIMIT ?",
+            (kind, node, time.time(), limit),
+        )
+
+    def count_work(self, kind, node=""):
+        return self.execute("SELECT COUNT(*) FROM work WHERE kind = ? AND node = ?", (kind, node))[0][0]
+
+    def adopt_work(self, node, nodes):
+        # Take over work of nodes that are gone, dropping items this node already holds
+        placeholders = ", ".join("?" * len(nodes))
+        with self.transaction():
+            self.execute(f"UPDATE OR IGNORE work SET node = ? WHERE node NOT IN ({placeholders})", (node, *nodes))
+            self.execute(f"DELETE FROM work WHERE node NOT IN ({placeholders})", nodes)
+
+    def get_crawl_progress(self, instance) -> Tuple[int, bool]:
+        rows = self.execute("SELECT page, finished FROM crawl_progress WHERE instance = ?", (instance,))
+        return (rows[0][0], bool(rows[0][1])) if rows else (1, False)
+
+    def set_crawl_progress(self, instance, page, finished=False):
+        self.execute(
+            "INSERT OR REPLACE INTO crawl_progress (instance, page, finished, updated_at) VALUES (?, ?, ?, ?)",
+            (instance, page, finished, time.time()),
+        )
+
+    def clear_crawl_progress(self, instance=None):
+        if instance is None:
+            self.execute("DELETE FROM crawl_progress")
+        else:
+            self.execute("DELETE FROM crawl_progress WHERE instance = ?", (instance,))
+
+    def get_schedule(self, instance):
+        rows = self.execute(
+            "SELECT next_visit, interval, yield_rate, failures, last_visit FROM instance_schedule WHERE instance = ?",
+            (instance,),
+        )
+        return rows[0] if rows else None
+
+    def get_schedules(self):
+        return {row[0]: row[1] for row in self.execute("SELECT instance, next_visit FROM instance_schedule")}
+
+    def set_schedule(self, instance, next_visit, interval, yield_rate, failures, last_visit):
+        self.execute(
+            "INSERT OR REPLACE INTO instance_schedule "
+            "(instance, next_visit, interval, yield_rate, failures, last_visit) VALUES (?, ?, ?, ?, ?, ?)",
+            (instance, next_visit, interval, yield_rate, failures, last_visit),
+        )
+
+    def get_instance_scan(self, instance):
+        rows = self.execute("SELECT scan FROM instance_scans WHERE instance = ?", (instance,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def set_instance_scan(self, instance, scan):
+        self.execute(
+            "INSERT OR REPLACE INTO instance_scans (instance, scan, updated_at) VALUES (?, ?, ?)",
+            (instance, json.dumps(scan), time.time()),
+        )
+
+    def get_health(self, instance):
+        rows = self.execute(
+            "SELECT latency, error_rate, failures, opened_until FROM instance_health WHERE instance = ?", (instance,)
+        )
+        return list(rows[0]) if rows else None
+
+    def set_health(self, instance, latency, error_rate, failures, opened_until):
+        self.execute(
+            "INSERT OR REPLACE INTO instance_health "
+            "(instance, latency, error_rate, failures, opened_until, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (instance, latency, error_rate, failures, opened_until, time.time()),
+        )
+
+    def count_open_circuits(self) -> int:
+        return self.execute("SELECT COUNT(*) FROM instance_health WHERE opened_until > ?", (time.time(),))[0][0]
+
+    def heartbeat(self, node):
+        self.execute(
+            "INSERT INTO nodes (node, heartbeat) VALUES (?, ?) "
+            "ON CONFLICT (node) DO UPDATE SET heartbeat = excluded.heartbeat",
+            (node, time.time()),
+        )
+
+    def get_nodes(self, since) -> list:
+        return [row[0] for row in self.execute("SELECT node FROM nodes WHERE heartbeat > ? ORDER BY node", (since,))]
+
+    def acquire_lease(self, key, node, expires_at) -> bool:
+        # Take over leases only once expired, or extend own lease
+        with self.transaction():
+            self.execute(
+                "INSERT INTO leases (key, node, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET node = excluded.node, expires_at = excluded.expires_at "
+                "WHERE leases.node = excluded.node OR leases.expires_at <= ?",
+                (key, node, expires_at, time.time()),
+            )
+            return self.execute("SELECT node FROM leases WHERE key = ?", (key,))[0][0] == node
+
+    def release_lease(self, key, node):
+        self.execute("DELETE FROM leases WHERE key = ? AND node = ?", (key, node))
+
+    def clear_expired_leases(self):
+        self.execute("DELETE FROM leases WHERE expires_at <= ?", (time.time(),))
+
+    def sync_communities(self, rows):
+        # Upsert (actor_id, id, subscribed) rows in bulk, never downgrading subscribed communities
+        now = time.time()
+        with self.transaction():
+            self.conn.executemany(
+                "INSERT INTO communities (actor_id, id, state, instance, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (actor_id) DO UPDATE SET "
+                "id = excluded.id, state = MAX(state, excluded.state), updated_at = excluded.updated_at",
+                [
+                    (
+                        actor_id,
+                        id,
+                        self.STATE_SUBSCRIBED if subscribed else self.STATE_RESOLVED,
+                        self.get_instance(actor_id),
+                        now,
+                        now,
+                    )
+                    for actor_id, id, subscribed in rows
+                ],
+            )
+
+    def statistics(self) -> Tuple[int, int]:
+        counts = dict(self.execute("SELECT state, count FROM statistics"))
+        subscribed = counts.get(self.STATE_SUBSCRIBED, 0)
+        return counts.get(self.STATE_RESOLVED, 0) + subscribed, subscribed
+
+
+class HostLimiter:
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    @contextlib.contextmanager
+    def acquire(self, host):
+        # Lazily create one semaphore per host
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.limit)
+            semaphore = self.semaphores[host]
+
+        # Hold slot for the duration of the request
+        with semaphore:
+            yield
+
+
+class WorkQueue:
+    def __init__(self, maxsize=0, store=None, kind=None, node=""):
+        self.maxsize = maxsize
+        self.store = store
+        self.kind = kind
+        self.node = node
+        self.heap = []
+        self.pending = {}
+        self.in_flight = set()
+        self.spilled = False
+        self.retry_delay = 300
+        self.max_attempts = 10
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def put(self, item, priority=0) -> bool:
+        with self.cond:
+            while True:
+                # Collapse duplicates already being worked on
+                if item in self.in_flight:
+                    return False
+
+                # Collapse duplicates already queued, bumping their priority if needed
+                if item in self.pending:
+                    if priority <= self.pending[item]:
+                        return False
+                    break
+
+                if self.maxsize <= 0 or len(self.pending) < self.maxsize:
+                    break
+
+                # Spill to the store when full instead of blocking the producer, get restores it lazily
+                if self.store is not None:
+                    self.store.add_work(self.kind, item, priority, self.node)
+                    self.spilled = True
+                    return True
+
+                # Otherwise wait for space
+                self.cond.wait()
+
+            # Stale heap entries of bumped items are skipped in get
+            self.push(item, priority)
+            if self.store is not None:
+                self.store.add_work(self.kind, item, priority, self.node)
+            return True
+
+    def push(self, item, priority):
+        self.pending[item] = priority
+        heapq.heappush(self.heap, (-priority, next(self.counter), item))
+        self.cond.notify_all()
+
+    def refill(self) -> int:
+        # Load highest priority persisted work not already queued or being worked on, up to maxsize
+        limit = self.maxsize + len(self.in_flight) if self.maxsize > 0 else -1
+        rows = self.store.get_work(self.kind, self.node, limit)
+        loaded = 0
+        for item, priority in rows:
+            if self.maxsize > 0 and len(self.pending) >= self.maxsize:
+                break
+            if item not in self.pending and item not in self.in_flight:
+                self.push(item, priority)
+                loaded += 1
+        self.spilled = limit >= 0 and len(rows) >= limit
+        return loaded
+
+    def restore(self) -> int:
+        # Reload persisted work, leaving anything beyond maxsize spilled
+        with self.cond:
+            self.refill()
+            return self.store.count_work(self.kind, self.node)
+
+    def get(self):
+        with self.cond:
+            while True:
+                # Pop highest priority item that is still pending
+                while self.heap:
+                    priority, _, item = heapq.heappop(self.heap)
+                    if self.pending.get(item) == -priority:
+                        del self.pending[item]
+                        self.in_flight.add(item)
+                        self.cond.notify_all()
+                        return item
+
+                # Restore spilled work once the queue ran empty
+                if self.spilled and self.refill() > 0:
+                    continue
+
+                # Return None once closed and drained
+                if self.closed:
+                    return None
+                self.cond.wait()
+
+    def done(self, item):
+        with self.cond:
+            self.in_flight.discard(item)
+            if self.store is not None and item not in self.pending:
+                self.store.remove_work(self.kind, item, self.node)
+
+    def fail(self, item):
+        # Keep failed work persisted for a retry with backoff, it is restored once due
+        with self.cond:
+            self.in_flight.discard(item)
+            if self.store is not None and item not in self.pending:
+                self.store.defer_work(self.kind, item, self.retry_delay, self.max_attempts, self.node)
+
+    def drain(self) -> list:
+        # Take all pending items at once, highest priority first
+        with self.cond:
+            items = sorted(self.pending.items(), key=lambda x: (-x[1], x[0]))
+            self.pending.clear()
+            self.heap.clear()
+            self.cond.notify_all()
+            return items
+
+    def open(self):
+        with self.cond:
+            self.closed = False
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def qsize(self):
+        with self.cond:
+            return len(self.pending)
+
+
+class RateLimiter:
+    def __init__(self, max_rate, min_rate=0.2, target_latency=2.0):
+        self.budget = max_rate
+        self.floor = min_rate
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.target_latency = target_latency
+        self.rate = max_rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                # Refill bucket, allowing a burst of up to one second worth of requests
+                now = time.monotonic()
+                self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                # Take token unless paused by server
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def share(self, parts):
+        # Split the rate budget evenly, e.g. between the live nodes of a shard
+        with self.lock:
+            self.max_rate = self.budget / max(1, parts)
+            self.min_rate = min(self.floor, self.budget) / max(1, parts)
+            self.rate = max(self.min_rate, min(self.rate, self.max_rate))
+            self.tokens = min(self.tokens, max(1.0, self.rate))
+
+    def feedback(self, latency, status_code=None, retry_after=None):
+        with self.lock:
+            if status_code in (429, 503):
+                # Back off hard when throttled, honouring Retry-After if given
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = 0.0
+                self.paused_until = time.monotonic() + self.parse_retry_after(retry_after, 1 / self.rate)
+                logger.warning(f"throttled by server, reducing rate to {self.rate:.2f}/s")
+            elif status_code is None or latency > self.target_latency:
+                # Back off gently when server slows down or times out
+                self.rate = max(self.min_rate, self.rate * 0.8)
+            else:
+                # Otherwise slowly ramp back up
+                self.rate = min(self.max_rate, self.rate + 0.1)
+
+    @staticmethod
+    def parse_retry_after(retry_after, default):
+        if retry_after is None:
+            return default
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return default
+
+
+class Scheduler:
+    def __init__(self, db, base_interval, min_interval, max_interval):
+        self.db = db
+        self.base_interval = base_interval
+        self.min_interval = min(min_interval, base_interval)
+        self.max_interval = max(max_interval, base_interval)
+        self.activity = {}
+
+    def get_due(self, instances, exclude=()) -> list:
+        # Instances never visited before are due immediately
+        now = time.time()
+        schedules = self.db.get_schedules()
+        due = [i for i in instances if i not in exclude and schedules.get(i, 0) <= now]
+        return sorted(due, key=lambda i: schedules.get(i, 0))
+
+    def defer(self, instance, next_visit):
+        # Push back next visit without touching interval statistics
+        entry = self.db.get_schedule(instance)
+        if entry is None:
+            self.db.set_schedule(instance, next_visit, self.base_interval, 0.0, 0, time.time())
+        elif entry[0] < next_visit:
+            self.db.set_schedule(instance, next_visit, *entry[1:])
+
+    def get_next_visit(self, instances) -> float:
+        schedules = self.db.get_schedules()
+        return min((schedules.get(i, 0) for i in instances), default=time.time() + self.base_interval)
+
+    def record_visit(self, instance, discovered, failed):
+        now = time.time()
+        entry = self.db.get_schedule(instance)
+        interval, yield_rate, failures = (entry[1], entry[2], entry[3]) if entry else (self.base_interval, 0.0, 0)
+
+        if failed:
+            # Back off exponentially from shortest interval on repeated failures
+            failures += 1
+            interval = min(self.max_interval, self.min_interval * 2 ** failures)
+        else:
+            # Revisit sooner the more new communities showed up recently,
+            # and back off gradually from instances that stopped yielding
+            failures = 0
+            yield_rate = 0.5 * yield_rate + 0.5 * discovered
+            if yield_rate >= 0.5:
+                interval = self.base_interval / (1 + yield_rate)
+            else:
+                interval = interval * 1.5
+
+            # Revisit busier instances more often
+            interval *= self.get_activity_factor(instance)
+
+        # Jitter to spread crawl load evenly
+        interval = min(self.max_interval, max(self.min_interval, interval)) * random.uniform(0.9, 1.1)
+        self.db.set_schedule(instance, now + interval, interval, yield_rate, failures, now)
+        logger.debug(f"scheduled '{instance}' in {interval:.0f} seconds ({yield_rate = :.2f}, {failures = })")
+
+    def get_activity_factor(self, instance):
+        # 1 for instances up to 100 active users, 1/2 at 1000, 1/3 at 10000, ...
+        activity = self.activity.get(instance, 0)
+        return 1 / max(1.0, math.log10(activity + 1) - 1)
+
+
+class HealthTracker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, db, failure_threshold=2, base_backoff=600, max_backoff=604800):
+        self.db = db
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get_entry(self, instance):
+        # Cache entries in memory, loading persisted health lazily
+        if instance not in self.entries:
+            self.entries[instance] = self.db.get_health(instance) or [0.0, 0.0, 0, 0.0]
+        return self.entries[instance]
+
+    def get_state(self, instance) -> str:
+        with self.lock:
+            _, _, failures, opened_until = self.get_entry(instance)
+        if failures < self.failure_threshold:
+            return self.CLOSED
+        if time.time() < opened_until:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def get_opened_until(self, instance) -> float:
+        with self.lock:
+            return self.get_entry(instance)[3]
+
+    def record_request(self, instance, latency, ok):
+        # Track moving averages of latency and error rate per request
+        with self.lock:
+            entry = self.get_entry(instance)
+            entry[0] = latency if entry[0] == 0 else 0.8 * entry[0] + 0.2 * latency
+            entry[1] = 0.8 * entry[1] + 0.2 * (0 if ok else 1)
+
+    def record_crawl(self, instance, ok):
+        with self.lock:
+            entry = self.get_entry(instance)
+            if ok:
+                # Close circuit again
+                entry[2] = 0
+                entry[3] = 0.0
+            else:
+                # Open circuit with exponential backoff once failure threshold is reached
+                entry[2] += 1
+                if entry[2] >= self.failure_threshold:
+                    backoff = min(self.max_backoff, self.base_backoff * 2 ** (entry[2] - self.failure_threshold))
+                    entry[3] = time.time() + backoff
+                    logger.warning(f"circuit opened for '{instance}' for {backoff} seconds ({entry[2]} failures)")
+            self.db.set_health(instance, *entry)
+
+
+class Shard:
+    def __init__(self, store, node, ttl=30, lease_ttl=600, replicas=64):
+        self.store = store
+        self.node = node
+        self.ttl = ttl
+        self.lease_ttl = lease_ttl
+        self.replicas = replicas
+        self.nodes = ()
+        self.ring = []
+        self.watchers = []
+        self.lock = threading.Lock()
+
+        # Join ring, and keep membership alive in background
+        self.heartbeat()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    @staticmethod
+    def hash(key) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def run(self):
+        while True:
+            time.sleep(self.ttl / 3)
+            try:
+                self.heartbeat()
+            except Exception as e:
+                logger.error(f"failed to send shard heartbeat - {e}")
+
+    def heartbeat(self):
+        self.store.heartbeat(self.node)
+        self.store.clear_expired_leases()
+
+        # Rebuild ring of virtual nodes whenever live membership changes
+        nodes = tuple(self.store.get_nodes(time.time() - self.ttl))
+        with self.lock:
+            if nodes != self.nodes:
+                logger.info(f"shard ring changed - {len(nodes)} nodes: {', '.join(nodes)}")
+                self.nodes = nodes
+                self.ring = sorted((self.hash(f"{node}#{i}"), node) for node in nodes for i in range(self.replicas))
+                for watcher in self.watchers:
+                    watcher(nodes)
+
+    def watch(self, watcher):
+        # Call watcher with the live nodes now and whenever membership changes
+        with self.lock:
+            self.watchers.append(watcher)
+            watcher(self.nodes)
+
+    def settle(self):
+        # Nodes started together only see each other once all of them sent a heartbeat
+        logger.info(f"waiting {self.ttl} seconds for shard membership to settle")
+        time.sleep(self.ttl)
+        self.heartbeat()
+
+    def adopt_work(self):
+        self.store.adopt_work(self.node, self.store.get_nodes(time.time() - self.ttl))
+
+    def owns(self, instance) -> bool:
+        # Instance belongs to the first virtual node clockwise of its hash
+        with self.lock:
+            if len(self.ring) == 0:
+                return True
+            i = bisect.bisect(self.ring, (self.hash(instance),))
+            return self.ring[i % len(self.ring)][1] == self.node
+
+    @contextlib.contextmanager
+    def lease(self, key):
+        acquired = self.store.acquire_lease(key, self.node, time.time() + self.lease_ttl)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.store.release_lease(key, self.node)
+
+
+class Tracer:
+    # cProfile sees every thread from Python 3.12 on, and only the thread it is enabled in before
+    PROFILE_ALL_THREADS = sys.version_info >= (3, 12)
+
+    def __init__(self, path=None, profile_path=None):
+        self.path = path
+        self.profile_path = profile_path
+        self.enabled = path is not None or profile_path is not None
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.threads = set()
+        self.profiles = []
+        self.generation = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+        # Profile whole cycles at once where cProfile is process-wide
+        self.profiler = None
+        if self.profile_path is not None and self.PROFILE_ALL_THREADS:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @contextlib.contextmanager
+    def span(self, name, category, target=None):
+        if not self.enabled:
+            yield
+            return
+        profiler = self.start_profile()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self.stop_profile(profiler)
+            self.add_event(name, category, start, end, target)
+
+    def start_profile(self):
+        # Otherwise the outermost span of each thread profiles itself
+        if self.profile_path is None or self.PROFILE_ALL_THREADS or getattr(self.local, "profiling", False):
+            return None
+
+        # Reuse one profiler per thread and cycle, as merging statistics is slow
+        with self.lock:
+            if getattr(self.local, "generation", None) != self.generation:
+                self.local.generation = self.generation
+                self.local.profiler = cProfile.Profile()
+                self.profiles.append(self.local.profiler)
+            profiler = self.local.profiler
+        profiler.enable()
+        self.local.profiling = True
+        return profiler
+
+    def stop_profile(self, profiler):
+        if profiler is None:
+            return
+        profiler.disable()
+        self.local.profiling = False
+
+    def add_event(self, name, category, start, end, target):
+        # Complete events in Chrome trace format, with thread names for readability
+        tid = threading.get_ident()
+        with self.lock:
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self.events.append({
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self.pid,
+                    "tid": tid,
+                    "args": {"name": threading.current_thread().name},
+                })
+            self.events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": self.pid,
+                "tid": tid,
+                "args": {"target": target} if target is not None else {},
+            })
+
+    def summarize(self, events, n=5):
+        # Sum span durations by phase, by crawled instance and by requested endpoint
+        phases = {}
+        instances = {}
+        endpoints = {}
+        for e in events:
+            if e["ph"] != "X":
+                continue
+            if e["cat"] == "request":
+                total, count = endpoints.get(e["name"], (0.0, 0))
+                endpoints[e["name"]] = (total + e["dur"], count + 1)
+                continue
+            phases[e["name"]] = phases.get(e["name"], 0.0) + e["dur"]
+            if e["name"] == "crawl_instance":
+                instances[e["args"]["target"]] = instances.get(e["args"]["target"], 0.0) + e["dur"]
+
+        for name, total in sorted(phases.items(), key=lambda x: x[1], reverse=True):
+            logger.info(f"phase '{name}' - {total / 1e6:.1f}s")
+        for instance, total in sorted(instances.items(), key=lambda x: x[1], reverse=True)[:n]:
+            logger.info(f"slowest instance '{instance}' - {total / 1e6:.1f}s")
+        for endpoint, (total, count) in sorted(endpoints.items(), key=lambda x: x[1][0], reverse=True)[:n]:
+            logger.info(
+                f"slowest endpoint '{endpoint}' - {total / 1e6:.1f}s over {count} requests, "
+                f"{total / count / 1e3:.0f}ms on average"
+            )
+
+    def flush(self):
+        # Summarize and write the finished cycle, starting a new one
+        if not self.enabled:
+            return
+        with self.lock:
+            events, self.events = self.events, []
+            profiles, self.profiles = self.profiles, []
+            self.generation += 1
+            self.threads = set()
+        self.summarize(events)
+
+        # Start profiling next cycle
+        if self.profiler is not None:
+            self.profiler.disable()
+            profiles.append(self.profiler)
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        if self.path is not None:
+            with open(self.path, "w") as f:
+                json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+            logger.info(f"wrote trace of {len(events)} events to '{self.path}'")
+        if self.profile_path is not None and len(profiles) > 0:
+            pstats.Stats(*profiles).dump_stats(self.profile_path)
+            logger.info(f"wrote profile to '{self.profile_path}'")
+
+
+def traced(category):
+    # Record a span for every call of a Bot method, targeted at its first argument
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            with self.tracer.span(f.__name__, category, args[0] if len(args) > 0 else None):
+                return f(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Metrics:
+    def __init__(self, port=None):
+        self.enabled = port is not None and prometheus_client is not None
+        if port is not None and prometheus_client is None:
+            logger.warning("prometheus_client is not installed - metrics endpoint disabled")
+        if not self.enabled:
+            return
+
+        # Register metrics in own registry to avoid exporting process defaults twice
+        self.registry = prometheus_client.CollectorRegistry()
+        self.request_duration = prometheus_client.Histogram(
+            "lsb_request_duration_seconds",
+            "HTTP request latency by remote host and API endpoint",
+            ["host", "endpoint"],
+            buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30),
+            registry=self.registry,
+        )
+        self.request_errors = prometheus_client.Counter(
+            "lsb_request_errors_total",
+            "HTTP request errors by remote host, API endpoint and reason",
+            ["host", "endpoint", "reason"],
+            registry=self.registry,
+        )
+        self.queue_depth = prometheus_client.Gauge(
+            "lsb_queue_depth", "Number of communities waiting in work queue", ["queue"], registry=self.registry
+        )
+        self.workers_busy = prometheus_client.Gauge(
+            "lsb_workers_busy", "Number of busy workers by pool", ["pool"], registry=self.registry
+        )
+        self.items = prometheus_client.Counter(
+            "lsb_items_total", "Number of items processed by crawl phase", ["phase"], registry=self.registry
+        )
+
+        # Serve metrics in background thread
+        prometheus_client.start_http_server(port, registry=self.registry)
+        logger.info(f"serving metrics on port {port}")
+
+    @staticmethod
+    def get_endpoint(path):
+        # Strip query strings and page numbers to keep label cardinality low
+        path = path.split("?")[0]
+        if path.startswith("/data/instance/"):
+            return "/data/instance"
+        return path
+
+    def observe_request(self, host, path, duration, error=None):
+        if not self.enabled:
+            return
+        endpoint = self.get_endpoint(path)
+        self.request_duration.labels(host, endpoint).observe(duration)
+        if error is not None:
+            self.request_errors.labels(host, endpoint, error).inc()
+
+    def track_queue(self, name, qsize):
+        if self.enabled:
+            self.queue_depth.labels(name).set_function(qsize)
+
+    @contextlib.contextmanager
+    def busy(self, pool):
+        if not self.enabled:
+            yield
+            return
+        gauge = self.workers_busy.labels(pool)
+        gauge.inc()
+        try:
+            yield
+        finally:
+            gauge.dec()
+
+    def count(self, phase, n=1):
+        if self.enabled:
+            self.items.labels(phase).inc(n)
+
+
+class Transport:
+    def __init__(
+        self, pool_size=10, connect_timeout=5, read_timeout=15, login=None, metrics=None, tracer=None, pool_connections=10
+    ):
+        self.metrics = metrics or Metrics()
+        self.tracer = tracer or Tracer()
+        self.timeout = (connect_timeout, read_timeout)
+        self.recorder = None
+
+        # One shared session, remote hosts share a bounded LRU of keep-alive pools
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        # Authentication state, login is called to refresh expired tokens
+        self.login = login
+        self.auth_headers = {}
+        self.auth_generation = 0
+        self.auth_lock = threading.Lock()
+
+    def mount(self, host, pool_size):
+        # Dedicated pool for a host that is always in use, like the home instance
+        self.session.mount(self.url(host, "/"), HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+    def url(self, host, path):
+        return f"https://{host}{path}"
+
+    def set_auth(self, headers):
+        self.auth_headers = headers
+        self.auth_generation += 1
+
+    def request(self, method, host, path, auth=False, **kwargs) -> requests.Response:
+        generation = self.auth_generation
+        r = self.send(method, host, path, auth, **kwargs)
+
+        # Refresh token once on expiry, unless another thread already did
+        if auth and self.login is not None and self.is_unauthorized(r):
+            with self.auth_lock:
+                if generation == self.auth_generation:
+                    logger.warning(f"authentication expired on '{host}', logging in again")
+                    self.login()
+            r = self.send(method, host, path, auth, **kwargs)
+        return r
+
+    def send(self, method, host, path, auth, headers=None, **kwargs) -> requests.Response:
+        headers = {**self.auth_headers, **(headers or {})} if auth else headers
+        start = time.monotonic()
+        try:
+            with self.tracer.span(f"{method} {Metrics.get_endpoint(path)}", "request", host):
+                r = self.session.request(
+                    method, self.url(host, path), headers=headers, timeout=self.timeout, **kwargs
+                )
+        except requests.exceptions.RequestException as e:
+            self.metrics.observe_request(host, path, time.monotonic() - start, type(e).__name__)
+            raise
+
+        # Record latency, and HTTP errors by status code
+        error = str(r.status_code) if r.status_code >= 400 else None
+        self.metrics.observe_request(host, path, time.monotonic() - start, error)
+
+        # Save unauthenticated responses for offline replay
+        if self.recorder is not None and not auth:
+            self.recorder.record(host, path, r)
+        return r
+
+    @staticmethod
+    def is_unauthorized(r):
+        return r.status_code == 401 or (r.status_code == 400 and "not_logged_in" in r.text)
+
+
+class Snapshot:
+    # Gzip-compressed json lines, a header with the crawl filters followed by one line per response
+    VERSION = 1
+
+    def __init__(self, path, header):
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.write({**header, "version": self.VERSION})
+
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+
+    def record(self, host, path, r):
+        self.write({"host": host, "path": path, "status": r.status_code, "body": r.text})
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    @staticmethod
+    def load(path) -> Tuple[dict, dict]:
+        responses = {}
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            if header.get("version") != Snapshot.VERSION:
+                raise ValueError(f"unsupported snapshot version '{header.get('version')}' in '{path}'")
+
+            # Prefer successful responses over failed attempts of the same request
+            for line in f:
+                entry = json.loads(line)
+                key = (entry["host"], entry["path"])
+                if key not in responses or responses[key]["status"] >= 500:
+                    responses[key] = entry
+        return header, responses
+
+
+class ReplayTransport(Transport):
+    def __init__(self, responses, metrics=None):
+        super().__init__(metrics=metrics)
+        self.responses = responses
+
+    def send(self, method, host, path, auth, headers=None, **kwargs) -> requests.Response:
+        # Serve recorded responses, anything not recorded is treated as unreachable
+        entry = self.responses.get((host, path))
+        if entry is None:
+            raise requests.exceptions.ConnectionError(f"'{host}{path}' not in snapshot")
+
+        r = requests.Response()
+        r.status_code = entry["status"]
+        r.url = self.url(host, path)
+        r.encoding = "utf-8"
+        r._content = entry["body"].encode()
+        return r
+
+
 class Bot:
+    # Largest page size accepted by community/list
+    PAGE_LIMIT = 50
+
+    # Sort matching the threshold metric, and fallback for instances predating it
+    SORT_EXACT = "TopSixMonths"
+    SORT_FALLBACK = "TopMonth"
+
     def __init__(
             self,
             domain,
@@ -52,8 +1332,30 @@ class Bot:
             nsfw=False,
             lang_codes=None,
             database="database.db",
+            crawl_workers=8,
+            crawl_host_workers=2,
+            sync=True,
+            lang_workers=4,
+            lang_cache_ttl=604800,
+            resolve_workers=2,
+            subscribe_workers=2,
+            rate_limit=5.0,
+            connect_timeout=5,
+            read_timeout=15,
+            full_crawl_interval=604800,
+            min_revisit=3600,
+            max_revisit=604800,
+            discovery_workers=4,
+            metrics_port=None,
+            metrics=None,
+            node_id=None,
+            profile=None,
+            profile_cprofile=None,
+            tracer=None,
+            store=None,
     ):
-        self.db = shelve.open(database)
+        self.db = Database(database)
+        self.store = store if store is not None else self.db  # shard membership, leases and work queues
         self.domain = domain  # e.g. lemmy.ml
         self.username = username
         self.password = password
@@ -65,10 +1367,45 @@ class Bot:
         self.bad_instances = []
         self.nsfw = nsfw
         self.lang_codes = lang_codes
+        self.crawl_workers = crawl_workers
+        self.sync = sync
+        self.lang_cache_ttl = lang_cache_ttl
+        self.resolve_workers = resolve_workers
+        self.subscribe_workers = subscribe_workers
+        self.full_crawl_interval = full_crawl_interval
+        self.discovery_workers = discovery_workers
+        self.crawl_tries = 3
+        self.targets = [self]
 
         # Prepare bot runtime variables
-        self.rq = queue.Queue(16)
-        self.sq = queue.Queue(16)
+        self.metrics = metrics or Metrics(metrics_port)
+        self.tracer = tracer or Tracer(profile, profile_cprofile)
+        self.shard = Shard(self.store, node_id) if node_id is not None else None
+        self.host_limiter = HostLimiter(crawl_host_workers)
+        self.limiter = RateLimiter(rate_limit)
+        if self.shard is not None:
+            # Nodes share the rate budget of the home instance
+            self.shard.watch(lambda nodes: self.limiter.share(len(nodes)))
+        self.health = HealthTracker(self.db)
+        self.scheduler = Scheduler(self.db, daemon_delay, min_revisit, max_revisit)
+        self.http = Transport(
+            crawl_host_workers,
+            connect_timeout,
+            read_timeout,
+            login=self.retrieve_jwt,
+            metrics=self.metrics,
+            tracer=self.tracer,
+            pool_connections=2 * crawl_workers,
+        )
+        self.http.mount(domain, resolve_workers + subscribe_workers + 1)
+        self.lang_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=lang_workers, thread_name_prefix="language"
+        )
+        self.rq = WorkQueue(1024, self.store, "resolve", node_id or "")
+        self.sq = WorkQueue(1024, self.store, "subscribe", node_id or "")
+        if metrics is None:
+            self.metrics.track_queue("resolve", self.rq.qsize)
+            self.metrics.track_queue("subscribe", self.sq.qsize)
         self.jwt = None
         self.headers = {}
 
@@ -78,295 +1415,809 @@ class Bot:
         if len(bad_instances) > 0:
             self.bad_instances = bad_instances
 
-        # Check db
-        if "_version" not in self.db:
-            self.db.clear()
-            self.db["_version"] = 1
-        if self.db["_version"] == 1:
-            pass
-
         # Print statistic
         self.print_statistic()
 
     def print_statistic(self):
-        resolved = 0
-        subscribed = 0
-        for k, v in self.db.items():
-            if k == "_version":
-                continue
-            resolved += 1
-            if v == -1:
-                subscribed += 1
-        logger.info(f"{resolved = } | {subscribed = }")
+        resolved, subscribed = self.db.statistics()
+        unhealthy = self.db.count_open_circuits()
+        logger.info(f"{self.domain}: {resolved = } | {subscribed = } | {unhealthy = }")
 
-    def start(self):
-        # Get JWT
-        self.retrieve_jwt()
+    def add_target(self, target):
+        # Fan crawled communities out to another home instance, with its own queues, workers and database
+        self.targets.append(target)
+        self.metrics.track_queue(f"resolve:{target.username}@{target.domain}", target.rq.qsize)
+        self.metrics.track_queue(f"subscribe:{target.username}@{target.domain}", target.sq.qsize)
 
-        # Start background threads
-        rt = threading.Thread(target=self.community_resolver_thread)
-        rt.daemon = True
-        rt.start()
-        st = threading.Thread(target=self.community_subscriber_thread)
-        st.daemon = True
-        st.start()
+    def get_crawl_threshold(self):
+        # Crawl deep enough for the most permissive target
+        return min(target.threshold_resolve for target in self.targets)
 
-        while True:
+    def start(self):
+        for target in self.targets:
+            # Get JWT
+            target.retrieve_jwt()
+
+            # Load communities already federated to home instance, by a single node if sharded
+            if target.sync:
+                key = f"sync:{target.username}@{target.domain}"
+                with target.shard.lease(key) if target.shard is not None else contextlib.nullcontext(True) as leased:
+                    if leased:
+                        target.sync_home_communities()
+                    else:
+                        logger.info(f"another node is syncing communities from '{target.domain}' - skipping")
+
+        # Let nodes started together see each other before claiming instances and work
+        if self.shard is not None:
+            self.shard.settle()
+
+        # Restore work left over from previous run, including work of nodes that went away if sharded
+        restored = 0
+        for target in self.targets:
+            if target.shard is not None:
+                target.shard.adopt_work()
+            target.rq.open()
+            target.sq.open()
+            restored += target.rq.restore() + target.sq.restore()
+        if restored > 0:
+            logger.info(f"restored {restored} pending communities from previous run")
+
+        # Start background worker pools of every target
+        rts = []
+        sts = []
+        for target in self.targets:
+            rts += [
+                threading.Thread(target=target.community_resolver_thread, daemon=True)
+                for _ in range(target.resolve_workers)
+            ]
+            sts += [
+                threading.Thread(target=target.community_subscriber_thread, daemon=True)
+                for _ in range(target.subscribe_workers)
+            ]
+        for t in rts + sts:
+            t.start()
+
+        if self.daemon:
+            # Revisit instances continuously as they become due
+            self.run_scheduler()
+        else:
             # Fill instances if not manually defined
             if self.instances is None or len(self.instances) == 0:
                 self.instances = self.get_instances()
 
-            # Loop through instances
-            for instance in self.instances:
-                # Skip bad instances
-                if instance in self.bad_instances:
-                    continue
-
-                # Skip own instance
-                if instance == self.domain:
-                    continue
-
-                # Otherwise, get communities
-                try:
-                    communities = self.get_instance_communities(instance)
-                except Exception as e:
-                    logger.error(f"failed to get instance '{instance}' communities: {e}")
+            # Crawl instances concurrently, results are handed off through the queues
+            self.crawl_instances(self.instances)
+            if self.shard is None:
+                self.db.clear_crawl_progress()
+            else:
+                for instance in self.get_crawlable_instances(self.instances):
+                    self.db.clear_crawl_progress(instance)
 
             # Print statistics
             logger.success("finished instance iteration")
-            self.print_statistic()
-
-            # Handle daemon
-            if self.daemon:
-                logger.success(f"sleeping for {self.daemon_delay} seconds")
-                time.sleep(self.daemon_delay)
-                continue
-            else:
-                break
+            for target in self.targets:
+                target.print_statistic()
 
-        # Exit queues
-        self.rq.put(None)
-        self.sq.put(None)
+        # Exit queues once drained
+        for target in self.targets:
+            target.rq.close()
+            target.sq.close()
 
         # Rejoin threads
-        rt.join()
-        st.join()
+        for t in rts + sts:
+            t.join()
+
+    def run_scheduler(self):
+        manual = self.instances is not None and len(self.instances) > 0
+        refreshed = 0
+        requeued = time.time()
+        reported = time.time()
+        running = {}
+
+        # Crawl instances in a long-lived bounded pool
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.crawl_workers, thread_name_prefix="crawler"
+        ) as executor:
+            while True:
+                # Refresh instance list from lemmyverse once per base interval
+                if not manual and time.time() - refreshed >= self.daemon_delay:
+                    self.instances = self.get_instances()
+                    refreshed = time.time()
+                instances = self.get_crawlable_instances(self.instances)
+
+                # Submit due instances, keeping at most one backlog of work per crawler
+                due = self.scheduler.get_due(instances, set(running.values()))
+                for instance in due[:max(0, 2 * self.crawl_workers - len(running))]:
+                    running[executor.submit(self.crawl_instance, instance)] = instance
+
+                # Wait for a crawl to finish or the next instance to become due
+                timeout = min(60.0, max(1.0, self.scheduler.get_next_visit(instances) - time.time()))
+                if len(running) == 0:
+                    logger.debug(f"no instances due, sleeping for {timeout:.0f} seconds")
+                    time.sleep(timeout)
+                else:
+                    done, _ = concurrent.futures.wait(
+                        running, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        self.db.clear_crawl_progress(running.pop(future))
+
+                # Requeue failed work once its backoff expired
+                if time.time() - requeued >= 60:
+                    for target in self.targets:
+                        target.rq.restore()
+                        target.sq.restore()
+                    requeued = time.time()
+
+                # Print statistics periodically
+                if time.time() - reported >= 3600:
+                    for target in self.targets:
+                        target.print_statistic()
+                    self.tracer.flush()
+                    reported = time.time()
+
+    def get_crawlable_instances(self, instances):
+        # Skip instances local to every target, or owned by other nodes if sharded
+        return [
+            i for i in instances
+            if i not in self.bad_instances
+            and any(target.domain != i for target in self.targets)
+            and (self.shard is None or self.shard.owns(i))
+        ]
+
+    @traced("crawl")
+    def crawl_instance(self, instance):
+        # Skip instances with open circuit until their backoff expires
+        state = self.health.get_state(instance)
+        if state == HealthTracker.OPEN:
+            logger.debug(f"skipping unhealthy instance '{instance}'")
+            self.scheduler.defer(instance, self.health.get_opened_until(instance))
+            return
+
+        # Probe half-open instances with a single attempt, otherwise retry with backoff
+        try:
+            tries = 1 if state == HealthTracker.HALF_OPEN else self.crawl_tries
+            with self.metrics.busy("crawler"):
+                discovered = retry_call(self.get_instance_communities, fargs=[instance], tries=tries, delay=1, backoff=2)
+        except Exception as e:
+            logger.error(f"failed to get instance '{instance}' communities: {e}")
+            discovered = None
+
+        # Crawls aborted by request errors count as failures
+        self.health.record_crawl(instance, discovered is not None)
+        if discovered is None:
+            self.scheduler.record_visit(instance, 0, True)
+            self.scheduler.defer(instance, self.health.get_opened_until(instance))
+            return
+        self.db.set_crawl_progress(instance, 1, True)
+        self.scheduler.record_visit(instance, discovered, False)
+        self.metrics.count("crawl_instances")
+
+    def crawl_instances(self, instances):
+        # Filter out instances that should not be crawled
+        instances = self.get_crawlable_instances(instances)
+
+        # Skip instances already finished by an interrupted run
+        remaining = [i for i in instances if not self.db.get_crawl_progress(i)[1]]
+        if len(remaining) < len(instances):
+            logger.info(f"resuming crawl - skipping {len(instances) - len(remaining)} finished instances")
+        instances = remaining
+
+        # Submit instances to bounded crawler pool
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.crawl_workers, thread_name_prefix="crawler"
+        ) as executor:
+            for _ in executor.map(self.crawl_instance, instances):
+                pass
+
+    def instance_get(self, instance, path, headers=None):
+        # Limit concurrent requests per remote host
+        with self.host_limiter.acquire(instance):
+            start = time.monotonic()
+            try:
+                r = self.http.request("GET", instance, path, headers=headers)
+            except requests.exceptions.RequestException:
+                self.health.record_request(instance, time.monotonic() - start, False)
+                raise
+
+        # Track instance health, rate limiting counts as failure
+        self.health.record_request(instance, time.monotonic() - start, r.status_code < 500 and r.status_code != 429)
+        return r
 
     def reset(self):
         # Get JWT
         self.retrieve_jwt()
 
-        # Get all subscribed communities
+        # Get all subscribed communities, keeping what was listed if a page fails
         communities = []
-        for i in range(1, 999):
-            try:
-                # Get and parse community list
-                r = session.get(
-                    f"https://{self.domain}/api/v3/community/list?type_=Subscribed&show_nsfw={str(self.nsfw).lower()}&page={i}",
-                    headers=self.headers
-                )
-                r_json = r.json()
-                if len(r_json["communities"]) == 0:
-                    break
-
-                # Add to communities
-                communities.extend(r_json["communities"])
-            except requests.exceptions.JSONDecodeError as e:
-                break
-            except requests.exceptions.Timeout as e:
-                logger.error(f"failed to get lemmyverse.net instances - {e}")
-                break
-            except Exception as e:
-                logger.exception(e)
-                break
+        complete = True
+        try:
+            for c in self.get_home_communities("Subscribed"):
+                communities.append(c)
+        except ListingException as e:
+            logger.error(e)
+            complete = False
         logger.debug(f"got {len(communities)} communities from server")
 
-        # Loop through communities and unsubscribe
+        # Only unsubscribe from bad instances if specified
+        if len(self.bad_instances) > 0:
+            communities = [
+                c for c in communities if Database.get_instance(c["community"]["actor_id"]) in self.bad_instances
+            ]
+
+        # Unsubscribe through rate-limited worker pool, using ids from community list
         i = 0
-        for community in communities:
-            if len(self.bad_instances) > 0:
-                actor_id = community["community"]["actor_id"]
-                instance = actor_id.split("/")[2]
-                if instance not in self.bad_instances:
-                    continue
-            self.unsubscribe_community(community["community"]["actor_id"], community["community"]["id"])
-            i += 1
-        logger.info(f"unsubscribed from {i}/{len(communities)} communities")
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.subscribe_workers, thread_name_prefix="unsubscriber"
+        ) as executor:
+            results = executor.map(
+                lambda c: self.unsubscribe_community(c["community"]["actor_id"], c["community"]["id"]), communities
+            )
+            for n, ok in enumerate(results, 1):
+                if ok:
+                    i += 1
+
+                # Report progress and throughput
+                if n % 100 == 0 or n == len(communities):
+                    rate = n / max(time.monotonic() - start, 1e-9)
+                    logger.info(f"unsubscribe progress: {n}/{len(communities)} ({rate:.1f}/s)")
+        if complete:
+            logger.info(f"unsubscribed from {i}/{len(communities)} communities")
+        else:
+            logger.error(f"unsubscribed from {i}/{len(communities)} listed communities, run reset again for the rest")
+
+    def plan(self) -> dict:
+        # Crawl without touching the home instance, collecting queued communities instead of working them off
+        for target in self.targets:
+            target.rq = WorkQueue()
+            target.sq = WorkQueue()
+        if self.instances is None or len(self.instances) == 0:
+            self.instances = self.get_instances()
+        self.crawl_instances(self.instances)
+
+        # Plans are keyed by target if fanning out
+        plans = {
+            f"{target.username}@{target.domain}": {
+                "subscribe": [{"actor_id": a, "users_active_half_year": n} for a, n in target.sq.drain()],
+                "resolve": [{"actor_id": a, "users_active_half_year": n} for a, n in target.rq.drain()],
+            }
+            for target in self.targets
+        }
+        return plans if len(self.targets) > 1 else next(iter(plans.values()))
+
+    def record(self, path) -> dict:
+        # Crawl live, saving every remote response to a snapshot
+        self.http.recorder = Snapshot(path, {
+            "threshold_resolve": self.get_crawl_threshold(),
+            "nsfw": self.nsfw,
+            "lang_codes": self.lang_codes,
+            "instances": self.instances,
+            "created_at": time.time(),
+        })
+        try:
+            plan = self.plan()
+        finally:
+            self.http.recorder.close()
+            self.http.recorder = None
+        logger.success(f"recorded crawl snapshot to '{path}'")
+        return plan
+
+    def replay(self, path) -> dict:
+        header, responses = Snapshot.load(path)
+        logger.info(f"loaded {len(responses)} responses from snapshot '{path}'")
+
+        # Pages below the recorded threshold, and languages of communities not looked up, are missing
+        if self.get_crawl_threshold() < header["threshold_resolve"]:
+            logger.warning(f"snapshot was recorded down to {header['threshold_resolve']} users - results are partial")
+        if self.lang_codes and (self.lang_codes != header["lang_codes"] or self.nsfw and not header["nsfw"]):
+            logger.warning("snapshot was recorded with different language or nsfw filters - results may be partial")
+
+        # Crawl recorded instances, failing fast on anything not recorded
+        if self.instances is None or len(self.instances) == 0:
+            self.instances = header["instances"]
+        self.http = ReplayTransport(responses, metrics=self.metrics)
+        self.crawl_tries = 1
+        return self.plan()
+
+    def home_request(self, method, path, **kwargs):
+        # Wait for rate limiter before hitting home instance
+        self.limiter.acquire()
+        start = time.monotonic()
+        try:
+            r = self.http.request(method, self.domain, path, auth=True, **kwargs)
+        except requests.exceptions.RequestException:
+            self.limiter.feedback(time.monotonic() - start)
+            raise
+
+        # Adapt rate to observed latency and throttling
+        self.limiter.feedback(time.monotonic() - start, r.status_code, r.headers.get("Retry-After"))
+        if r.status_code in (429, 503):
+            raise RateLimitException(f"{method} {path} - {r.status_code}")
+        return r
+
+    def get_home_communities(self, listing_type):
+        # Page through community list of home instance, fetching pages concurrently in batches
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.discovery_workers, thread_name_prefix="home"
+        ) as executor:
+            for batch in range(1, 99999, self.discovery_workers):
+                pages = executor.map(
+                    functools.partial(self.get_home_community_page, listing_type),
+                    range(batch, batch + self.discovery_workers),
+                )
+                try:
+                    for communities in pages:
+                        if not communities:
+                            return
+
+                        # Yield page
+                        yield from communities
+                except (requests.exceptions.RequestException, RateLimitException, ListingException) as e:
+                    # Any missing page leaves the listing incomplete, which callers must not mistake for its end
+                    raise ListingException(f"incomplete '{listing_type}' communities from '{self.domain}' - {e}") from e
+
+    @retry(RateLimitException, tries=5)
+    def get_home_community_page(self, listing_type, page) -> list:
+        # Get and parse community list, throttled pages are retried once the limiter pause has passed
+        r = self.home_request(
+            "GET",
+            f"/api/v3/community/list?type_={listing_type}&show_nsfw={str(self.nsfw).lower()}"
+            f"&limit={self.PAGE_LIMIT}&page={page}",
+        )
+        try:
+            r_json = r.json()
+        except requests.exceptions.JSONDecodeError:
+            r_json = None
+        if r.status_code != 200 or not isinstance(r_json, dict) or "communities" not in r_json:
+            raise ListingException(f"page {page} - {r.status_code}")
+        return r_json["communities"]
+
+    def sync_home_communities(self):
+        # Bulk load communities already known to home instance, subscribed ones first
+        complete = True
+        for listing_type in ["Subscribed", "All"]:
+            rows = []
+            try:
+                for c in self.get_home_communities(listing_type):
+                    subscribed = listing_type == "Subscribed" or c.get("subscribed") == "Subscribed"
+                    rows.append((c["community"]["actor_id"], c["community"]["id"], subscribed))
+
+                    # Flush in batches to keep transactions short
+                    if len(rows) >= 1000:
+                        self.db.sync_communities(rows)
+                        rows = []
+            except ListingException as e:
+                logger.error(e)
+                complete = False
+            self.db.sync_communities(rows)
+
+        # Print statistics
+        if complete:
+            logger.success(f"synced communities from '{self.domain}'")
+        else:
+            logger.error(f"synced communities from '{self.domain}' partially, unlisted ones are resolved when crawled")
+        self.print_statistic()
 
     @logger.catch(reraise=True, message="failed to login")
     def retrieve_jwt(self):
         payload = {"username_or_email": self.username, "password": self.password}
-        r = session.post(f"https://{self.domain}/api/v3/user/login", json=payload)
+        r = self.http.request("POST", self.domain, "/api/v3/user/login", json=payload)
         self.jwt = r.json()["jwt"]
         self.headers = {
             'Authorization': 'Bearer ' + self.jwt,
             'Content-Type': 'application/json'
         }
+        self.http.set_auth(self.headers)
         logger.success(f"logged in as: {self.username}")
 
+    @traced("discovery")
     def get_instances(self):
-        # Loop through Lemmyverse instance URLs
+        # Fetch Lemmyverse instance pages concurrently in batches until past the last page
         instances = []
-        for i in range(999):
-            try:
-                # Get and parse instance list
-                r = session.get(f"https://lemmyverse.net/data/instance/{i}.json")
-                data = r.json()
-                instances.extend(data)
-            except requests.exceptions.JSONDecodeError:
-                # expected exception, lemmyverse returns a valid html page once past last valid instance json
-                break
-            except requests.exceptions.Timeout as e:
-                logger.error(f"failed to get lemmyverse.net instances - {e}")
-                break
-            except Exception as e:
-                logger.exception(e)
-                break
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.discovery_workers, thread_name_prefix="discovery"
+        ) as executor:
+            for batch in range(0, 999, self.discovery_workers):
+                pages = executor.map(self.get_lemmyverse_page, range(batch, batch + self.discovery_workers))
+                last = False
+                for page in pages:
+                    if page is None:
+                        last = True
+                        break
+                    instances.extend(page)
+                if last:
+                    break
 
         # Get baseurls
         baseurls = []
-        for instance in sorted(instances, key=lambda x: x["score"], reverse=True):
+        for baseurl, score, active_half_year in sorted(instances, key=lambda x: x[1], reverse=True):
             # Check user count, and skip if below resolve threshold
-            if instance["usage"]["users"]["activeHalfyear"] < self.threshold_resolve:
+            if active_half_year < self.get_crawl_threshold():
                 continue
 
             # Add URL
-            baseurls.append(instance["baseurl"])
+            baseurls.append(baseurl)
+            self.scheduler.activity[baseurl] = active_half_year
 
         # Return results
         logger.info(f"loaded {len(baseurls)} instances from lemmyverse.net")
         return baseurls
 
-    @retry(tries=3)
-    def get_instance_communities(self, instance):
+    def get_lemmyverse_page(self, i) -> Optional[list]:
+        # Revalidate cached page if available
+        key = f"lemmyverse:{i}"
+        cached = self.db.cache_get(key)
+        headers = {}
+        if cached is not None and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached is not None and cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        try:
+            # Get and parse instance list
+            r = self.http.request("GET", "lemmyverse.net", f"/data/instance/{i}.json", headers=headers)
+            if r.status_code == 304 and cached is not None:
+                return [tuple(instance) for instance in cached["instances"]]
+            data = json_loads(r.content) if r.status_code == 200 else None
+            if not isinstance(data, list):
+                raise ValueError(f"unexpected response {r.status_code}: '{r.text[:200]}'")
+
+            # Keep only fields needed for ordering and filtering
+            instances = [(x["baseurl"], x["score"], x["usage"]["users"]["activeHalfyear"]) for x in data]
+        except json.JSONDecodeError:
+            # expected exception, lemmyverse returns a valid html page once past last valid instance json
+            return None
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            # Keep using cached page on errors, rate limiting and timeouts
+            logger.error(f"failed to get lemmyverse.net instances page {i} - {e}")
+            return [tuple(instance) for instance in cached["instances"]] if cached is not None else None
+
+        self.metrics.count("discovery_pages")
+        self.db.cache_set(
+            key,
+            {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified"), "instances": instances},
+            30 * 86400,
+        )
+        return instances
+
+    def get_instance_communities(self, instance) -> int:
         # If language filter specified, get supported language codes
         lang_ids = []
         if self.lang_codes is not None and len(self.lang_codes) > 0:
-            logger.trace(f"retrieving instance details - {instance}")
-            r = session.get(f"https://{instance}/api/v3/site")
-            # sorting logic:
-            # https://github.com/LemmyNet/lemmy/blob/0c82f4e66065b5772fede010a879d327135dbb1e/crates/db_views_actor/src/community_view.rs#L171
-            r_json = r.json()
-
-            # Loop through all langauges and resolve code
-            all_languages = r_json["all_languages"]
-            for language in all_languages:
-                for lang_code in self.lang_codes:
-                    if lang_code == language["code"]:
-                        lang_ids.append(language["id"])
+            lang_ids = self.get_instance_lang_ids(instance)
 
             # If unable to resolve code, play safe and skip
             if len(lang_ids) != len(self.lang_codes):
                 logger.error(f"unable to resolve language code from '{instance}' - skipping")
-                return
+                return 0
 
             # else proceed
-            logger.info(f"resolved language code of '{self.lang_codes}' to '{lang_ids}' on '{instance}'")
+            logger.debug(f"resolved language code of '{self.lang_codes}' to '{lang_ids}' on '{instance}'")
+
+        # Resume from last crawled page of an interrupted run
+        start_page, _ = self.db.get_crawl_progress(instance)
+        if start_page > 1:
+            logger.info(f"resuming '{instance}' from page {start_page}")
+
+        # Plan pagination, sorting by the threshold metric if supported by the instance
+        sort = self.get_community_sort(instance)
+
+        # Crawl incrementally if previous crawl is recent enough
+        scan = self.db.get_instance_scan(instance)
+        incremental = start_page == 1 and self.is_incremental_scan(scan, sort)
+        pages = {}
+        if scan is not None and start_page > 1:
+            pages = {p: v for p, v in scan["pages"].items() if int(p) < start_page}
+        skipped = []
+        fetched = 0
+        discovered = 0
+        complete = False
+        failed = False
+
+        page = start_page
+        while page < 99999:
+            key = str(page)
+            stored = scan["pages"].get(key) if scan is not None else None
+
+            # Skip pages that did not contain any threshold boundary during previous crawl
+            if incremental and stored is not None and not self.should_fetch_page(scan, page):
+                logger.trace(f"skipping unchanged communities - {instance} / page {page}")
+                pages[key] = stored
+                skipped.append(page)
+                page += 1
+                continue
+
+            # Revalidate with conditional request metadata of previous crawl
+            headers = {}
+            if stored is not None and stored.get("etag"):
+                headers["If-None-Match"] = stored["etag"]
+            if stored is not None and stored.get("last_modified"):
+                headers["If-Modified-Since"] = stored["last_modified"]
 
-        communities = []
-        for page in range(1, 99999):
             try:
                 logger.trace(f"retrieving communities - {instance} / page {page}")
-                r = session.get(f"https://{instance}/api/v3/community/list?type_=Local&sort=TopMonth&page={page}")
-                # sorting logic:
+                r = self.instance_get(
+                    instance,
+                    f"/api/v3/community/list?type_=Local&sort={sort}&limit={self.PAGE_LIMIT}&page={page}",
+                    headers=headers,
+                )
+                fetched += 1
+                self.metrics.count("crawl_pages")
+                # sorting logic, TopSixMonths orders by users_active_half_year, TopMonth by users_active_month:
                 # https://github.com/LemmyNet/lemmy/blob/0c82f4e66065b5772fede010a879d327135dbb1e/crates/db_views_actor/src/community_view.rs#L171
-                r_json = r.json()
-            except requests.exceptions.JSONDecodeError as e:
+                not_modified = r.status_code == 304
+                unknown_sort = r.status_code == 400 and "unknown variant" in r.text
+                records = CommunityRecord.parse_list(r.content) if r.status_code == 200 else None
+            except json.JSONDecodeError as e:
                 logger.error(f"failed to get communities from '{instance}' - {e}: '{r.text}'")
+                failed = True
                 break
             except requests.exceptions.Timeout as e:
                 logger.error(f"failed to get communities from '{instance}' - {e}")
+                failed = True
                 break
             except Exception as e:
                 logger.exception("unhandled exception")
+                failed = True
                 break
 
-            # If communities key is missing, break
-            if "communities" not in r_json:
-                break
+            # Fall back to TopMonth on instances that reject or ignore TopSixMonths, but not on transient errors
+            ignored_sort = records is not None and not self.is_sorted_page(records)
+            if page == 1 and sort == self.SORT_EXACT and (unknown_sort or ignored_sort):
+                logger.debug(f"'{instance}' does not support sorting by {sort} - falling back to {self.SORT_FALLBACK}")
+                sort = self.SORT_FALLBACK
+                self.db.cache_set(f"community_sort:{instance}", sort, 30 * 86400)
+                incremental = False
+                continue
 
-            # If no communities, also break
-            communities = r_json["communities"]
-            if len(communities) == 0:
+            # Rate limiting, server errors and error bodies abort the crawl, so it counts as failure
+            if not not_modified and records is None:
+                logger.error(f"failed to get communities from '{instance}' - {r.status_code}: '{r.text[:200]}'")
+                failed = True
                 break
 
-            # Loop through and append community lists
-            for c in communities:
-                name = c["community"]["name"]
-                users_active_half_year = c["counts"]["users_active_half_year"]
-                actor_id = c["community"]["actor_id"]
-                community_addr = actor_id
-                logger.debug(f"COMMUNITY: {instance}/{name} - {name} - {users_active_half_year = }")
-
-                # Skip if entirely subscribed
-                if community_addr in self.db and self.db[community_addr] == -1:
-                    logger.debug(f"SKIPPING SUBSCRIBED: {instance}/{name}")
-                    continue
-
-                # Check if nsfw filter passes
-                if self.nsfw == False and c["community"]["nsfw"] == True:
-                    logger.debug(f"SKIPPING NSFW: {instance}/{name}")
-                    continue
-
-                # Get community details if language filter specified
-                if len(lang_ids) > 0:
-                    try:
-                        logger.trace(f"retrieving community details - {instance} / {name}")
-                        r = session.get(f"https://{instance}/api/v3/community?name={name}")
-                        # sorting logic:
-                        # https://github.com/LemmyNet/lemmy/blob/0c82f4e66065b5772fede010a879d327135dbb1e/crates/db_views_actor/src/community_view.rs#L171
-                        r_json = r.json()
-                    except requests.exceptions.JSONDecodeError as e:
-                        logger.error(f"failed to get communities from '{instance}' - {e}: '{r.text}'")
-                        break
-                    except requests.exceptions.Timeout as e:
-                        logger.error(f"failed to get communities from '{instance}' - {e}")
-                        break
-                    except Exception as e:
-                        logger.exception("unhandled exception")
-                        break
-
-                    # If discussion langauge not specified, or configured language not in discussion languages, skip
-                    logger.info(f"{lang_ids} {r_json['discussion_languages']}")
-                    logger.info(f'{[id for id in r_json["discussion_languages"] if id in lang_ids]}')
-                    if "discussion_languages" not in r_json or len(r_json["discussion_languages"]) == 0:
-                        logger.debug(f"SKIPPING LANGUAGE: {instance}/{name}")
-                        continue
-                    elif len([id for id in r_json["discussion_languages"] if id in lang_ids]) == 0:
-                        logger.debug(f"SKIPPING LANGUAGE: {instance}/{name}")
-                        continue
+            if not_modified and stored is not None:
+                # Page not modified since previous crawl
+                pages[key] = stored
+            else:
+                # If no communities, break
+                communities = records or []
+                if len(communities) == 0:
+                    complete = True
+                    break
 
-                # Check if users_active_half_year has passed threshold
-                # to either resolve or subscribe.
-                if users_active_half_year >= self.threshold_subscribe:
-                    if community_addr in self.db and self.db[community_addr] == -1:
-                        logger.debug(f"SKIPPING SUBSCRIBED: {instance}/{name}")
+                # Filter and queue communities
+                discovered += self.queue_communities(instance, communities, lang_ids)
+                pages[key] = {
+                    "hash": self.fingerprint_page(communities),
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "first_count": communities[0].users_active_half_year,
+                    "last_count": communities[-1].users_active_half_year,
+                    "count": len(communities),
+                    "max_count": max(c.users_active_half_year for c in communities),
+                }
+
+                # Fall back to full crawl if any fetched page changed, as new communities shift
+                # every following page down to the boundary pages. Fetch skipped pages again.
+                if incremental and stored is not None and pages[key]["hash"] != stored["hash"]:
+                    logger.debug(f"communities changed on '{instance}' page {page} - crawling all pages")
+                    incremental = False
+                    if len(skipped) > 0:
+                        page = skipped[0]
                         continue
 
-                    logger.info(f"QUEUED SUBSCRIBE: {instance}/{name}")
-                    self.sq.put(actor_id)
+            # Record cursor, everything up to this page is persisted in the work queues
+            self.db.set_crawl_progress(instance, page + 1)
 
-                elif users_active_half_year >= self.threshold_resolve:
-                    if community_addr in self.db:
-                        logger.debug(f"SKIPPING RESOLVED: {instance}/{name}")
-                        continue
-
-                    logger.info(f"QUEUED RESOLVE: {instance}/{name}")
-                    self.rq.put(actor_id)
+            # Break loop once community list sorted by users_active_half_year drops below
+            # threshold as there are no more communities above threshold. With the
+            # TopMonth fallback this is only a heuristic.
+            if pages[key]["last_count"] < self.get_crawl_threshold():
+                complete = True
+                break
 
-            # Break loop once sorted-by-subscribers community list drops
-            # below threshold as there is likely no more communities
-            # above threshold
-            if communities[-1]["counts"]["users_active_half_year"] < self.threshold_resolve:
+            # Break loop on short page as it is the last one
+            if pages[key].get("count", self.PAGE_LIMIT) < self.PAGE_LIMIT:
+                complete = True
                 break
+            page += 1
+
+        # Save fingerprint for next incremental crawl
+        if complete and len(pages) > 0:
+            now = time.time()
+            self.db.set_instance_scan(instance, {
+                "filters": self.get_scan_filters(),
+                "sort": sort,
+                "pages": pages,
+                "subscribe_depths": [
+                    max([int(p) for p, v in pages.items() if v.get("max_count", v.get("first_count", 0)) >= target.threshold_subscribe], default=0)
+                    for target in self.targets
+                ],
+                "resolve_depth": max(int(p) for p in pages),
+                "top_count": pages.get("1", {}).get("first_count"),
+                "last_seen": now,
+                "last_full": scan["last_full"] if incremental else now,
+            })
+
+        # Raise on aborted crawls so they are retried with backoff, resuming from the failed page
+        if failed:
+            raise CrawlException(f"aborted on page {page} after {fetched} requests")
+
+        mode = "incremental" if incremental else "full"
+        logger.info(f"crawled '{instance}' - {fetched} requests ({mode}), {discovered} new communities queued")
+        return discovered
+
+    def get_scan_filters(self):
+        filters = [self.threshold_resolve, self.threshold_subscribe, self.nsfw, self.lang_codes]
+        return filters + [[t.domain, t.threshold_resolve, t.threshold_subscribe] for t in self.targets[1:]]
+
+    def is_incremental_scan(self, scan, sort):
+        # Only trust previous crawl if recent, and crawled with the same filters and sorting
+        if scan is None or self.full_crawl_interval <= 0:
+            return False
+        if time.time() - scan["last_full"] >= self.full_crawl_interval or "subscribe_depths" not in scan:
+            return False
+        return scan["filters"] == self.get_scan_filters() and scan.get("sort") == sort
+
+    def get_community_sort(self, instance):
+        return self.db.cache_get(f"community_sort:{instance}") or self.SORT_EXACT
+
+    @staticmethod
+    def is_sorted_page(communities):
+        # Pages not ordered by users_active_half_year indicate unsupported sorting
+        return all(a.users_active_half_year >= b.users_active_half_year for a, b in zip(communities, communities[1:]))
+
+    @staticmethod
+    def should_fetch_page(scan, page):
+        # Threshold-crossing communities show up around the subscribe boundaries and at the resolve
+        # boundary. New communities at any rank shift every following page, which changes the
+        # fingerprints of the fetched boundary pages.
+        if page == 1 or page >= scan["resolve_depth"]:
+            return True
+        return any(page in (depth, depth + 1) for depth in scan["subscribe_depths"])
+
+    def fingerprint_page(self, communities):
+        # Hash page membership and threshold class, ignoring order and exact counts
+        thresholds = [t for target in self.targets for t in (target.threshold_resolve, target.threshold_subscribe)]
+        entries = sorted((c.actor_id, sum(c.users_active_half_year >= t for t in thresholds)) for c in communities)
+        return hashlib.sha1(json.dumps(entries).encode()).hexdigest()
+
+    def queue_communities(self, instance, communities, lang_ids) -> int:
+        # Loop through and collect communities that would be queued by any target
+        candidates = []
+        for c in communities:
+            name = c.name
+            users_active_half_year = c.users_active_half_year
+            logger.debug(f"COMMUNITY: {instance}/{name} - {name} - {users_active_half_year = }")
+
+            # Check if nsfw filter passes
+            if self.nsfw == False and c.nsfw == True:
+                logger.debug(f"SKIPPING NSFW: {instance}/{name}")
+                continue
 
+            # Collect queues of targets the community passes thresholds for
+            queues = [(target, target.select_queue(instance, c)) for target in self.targets]
+            queues = [(target, q) for target, q in queues if q is not None]
+            if len(queues) > 0:
+                candidates.append((c, queues))
+
+        # Filter by community languages if language filter specified, once for all targets
+        if len(lang_ids) > 0:
+            candidates = self.filter_community_languages(instance, candidates, lang_ids)
+
+        # Queue remaining communities, counting only those new to their target as scheduling yield,
+        # as communities failing to subscribe are queued again on every visit
+        discovered = 0
+        for c, queues in candidates:
+            for target, q in queues:
+                known = target.db.is_known(c.actor_id)
+                if q.put(c.actor_id, c.users_active_half_year):
+                    on = f" on '{target.domain}'" if len(self.targets) > 1 else ""
+                    logger.info(f"QUEUED {'SUBSCRIBE' if q is target.sq else 'RESOLVE'}{on}: {instance}/{c.name}")
+                    self.metrics.count("queued_subscribe" if q is target.sq else "queued_resolve")
+                    discovered += not known
+        return discovered
+
+    def select_queue(self, instance, c) -> Optional[WorkQueue]:
+        name = c.name
+        users_active_half_year = c.users_active_half_year
+        community_addr = c.actor_id
+
+        # Skip communities local to home instance
+        if instance == self.domain:
+            return None
+
+        # Skip if entirely subscribed
+        if self.db.is_subscribed(community_addr):
+            logger.debug(f"SKIPPING SUBSCRIBED: {instance}/{name}")
+            return None
+
+        # Check if users_active_half_year has passed threshold
+        # to either resolve or subscribe.
+        if users_active_half_year >= self.threshold_subscribe:
+            return self.sq
+        if users_active_half_year >= self.threshold_resolve:
+            if self.db.is_known(community_addr):
+                logger.debug(f"SKIPPING RESOLVED: {instance}/{name}")
+                return None
+            return self.rq
+        return None
+
+    @traced("language")
+    def get_instance_lang_ids(self, instance):
+        # Get language table from cache, otherwise from instance
+        key = f"site_languages:{instance}"
+        languages = self.db.cache_get(key)
+        if languages is None:
+            logger.trace(f"retrieving instance details - {instance}")
+            r = self.instance_get(instance, "/api/v3/site")
+            languages = {language["code"]: language["id"] for language in r.json()["all_languages"]}
+            self.db.cache_set(key, languages, self.lang_cache_ttl)
+
+        # Resolve configured codes
+        return [languages[lang_code] for lang_code in self.lang_codes if lang_code in languages]
+
+    @traced("language")
+    def get_community_languages(self, instance, name, actor_id):
+        # Get discussion languages from cache, otherwise from instance
+        key = f"community_languages:{actor_id}"
+        discussion_languages = self.db.cache_get(key)
+        if discussion_languages is not None:
+            return discussion_languages
+
+        try:
+            logger.trace(f"retrieving community details - {instance} / {name}")
+            r = self.instance_get(instance, f"/api/v3/community?name={name}")
+            r_json = json_loads(r.content)
+        except json.JSONDecodeError as e:
+            logger.error(f"failed to get community details from '{instance}' - {e}: '{r.text}'")
+            return None
+        except requests.exceptions.Timeout as e:
+            logger.error(f"failed to get community details from '{instance}' - {e}")
+            return None
+        except Exception as e:
+            logger.exception("unhandled exception")
+            return None
+
+        # Do not cache rate limiting or error responses, the community is looked up again next visit
+        if r.status_code != 200 or not isinstance(r_json, dict) or "error" in r_json:
+            logger.error(f"failed to get community details from '{instance}' - {r.status_code}: '{r.text}'")
+            return None
+
+        # Cache result, including communities without any discussion languages
+        self.metrics.count("language_lookups")
+        discussion_languages = r_json.get("discussion_languages", [])
+        self.db.cache_set(key, discussion_languages, self.lang_cache_ttl)
+        return discussion_languages
+
+    def filter_community_languages(self, instance, candidates, lang_ids):
+        # Look up discussion languages concurrently in bounded pool
+        futures = [
+            self.lang_executor.submit(self.get_community_languages, instance, c.name, c.actor_id)
+            for c, _ in candidates
+        ]
+
+        # If discussion langauge not specified, or configured language not in discussion languages, skip
+        results = []
+        for (c, queues), future in zip(candidates, futures):
+            discussion_languages = future.result()
+            if not discussion_languages or not any(id in lang_ids for id in discussion_languages):
+                logger.debug(f"SKIPPING LANGUAGE: {instance}/{c.name}")
+                continue
+            results.append((c, queues))
+        return results
+
+    @traced("home")
     def resolve_community(self, community_addr) -> int:
-        # Return if already subscribed in database
-        if community_addr in self.db and self.db[community_addr] > 0:
-            return self.db[community_addr]
+        # Return if already resolved in database
+        id = self.db.get_id(community_addr)
+        if id is not None:
+            return id
 
         # Attempt to resolve
-        r = session.get(f"https://{self.domain}/api/v3/resolve_object?q={community_addr}", headers=self.headers)
+        r = self.home_request("GET", f"/api/v3/resolve_object?q={community_addr}")
         r_json = r.json()
 
         # Check if there is an error
@@ -375,13 +2226,15 @@ class Bot:
 
         # Return result
         logger.info(f"RESOLVED: {community_addr}")
-        self.db[community_addr] = r_json["community"]["community"]["id"]
+        self.metrics.count("resolved")
+        self.db.set_resolved(community_addr, r_json["community"]["community"]["id"])
         return r_json["community"]["community"]["id"]
 
+    @traced("home")
     @retry(tries=3)
     def subscribe_community(self, community_addr):
         # Return if already subscribed in database
-        if community_addr in self.db and self.db[community_addr] == -1:
+        if self.db.is_subscribed(community_addr):
             return
 
         # Attempt to resolve
@@ -389,59 +2242,72 @@ class Bot:
 
         # Attempt to subscribe
         follow_payload = {"community_id": id, "follow": True}
-        r = session.post(f"https://{self.domain}/api/v3/community/follow", timeout=15, json=follow_payload,
-                         headers=self.headers)
+        r = self.home_request("POST", "/api/v3/community/follow", json=follow_payload)
         r_json = r.json()
 
         # Log and mark as subscribed in DB
         logger.trace(f"{community_addr} - {r.text}")
         logger.info(f"SUBSCRIBED: {community_addr}")
-        self.db[community_addr] = -1
+        self.metrics.count("subscribed")
+        self.db.set_subscribed(community_addr, id)
 
     @logger.catch(message="failed to unsub")
     @retry(tries=3)
-    def unsubscribe_community(self, community_addr, community_id):
-        # Attempt to resolve
-        id = self.resolve_community(community_addr)
-
+    def unsubscribe_community(self, community_addr, community_id) -> bool:
         # Attempt to unsubscribe
-        follow_payload = {"community_id": id, "follow": False}
-        r = session.post(f"https://{self.domain}/api/v3/community/follow", timeout=15, json=follow_payload,
-                         headers=self.headers)
+        follow_payload = {"community_id": community_id, "follow": False}
+        r = self.home_request("POST", "/api/v3/community/follow", json=follow_payload)
         r_json = r.json()
 
         # Log and mark as subscribed in DB
         logger.trace(f"{community_addr} - {r.text}")
         logger.info(f"UNSUBSCRIBED: {community_addr}")
-        self.db[community_addr] = community_id
+        self.metrics.count("unsubscribed")
+        self.db.set_resolved(community_addr, community_id)
+        return True
+
+    @contextlib.contextmanager
+    def lease(self, community_addr):
+        # Only one node works on a community at a time if sharded
+        if self.shard is None:
+            yield True
+            return
+        with self.shard.lease(f"{self.username}@{self.domain}:{community_addr}") as leased:
+            if not leased:
+                logger.debug(f"SKIPPING LEASED: {community_addr}")
+            yield leased
 
     def community_resolver_thread(self):
         while True:
             community_addr = self.rq.get()
             if community_addr is None:
                 return
-            if community_addr in self.db:
-                continue
 
             try:
-                self.resolve_community(community_addr)
+                with self.metrics.busy("resolver"), self.lease(community_addr) as leased:
+                    if leased and not self.db.is_known(community_addr):
+                        self.resolve_community(community_addr)
             except Exception:
                 logger.error(f"failed to resolve community '{community_addr}'")
-            time.sleep(1)
+                self.rq.fail(community_addr)
+            else:
+                self.rq.done(community_addr)
 
     def community_subscriber_thread(self):
         while True:
             community_addr = self.sq.get()
             if community_addr is None:
                 return
-            if community_addr in self.db and self.db[community_addr] == -1:
-                continue
 
             try:
-                self.subscribe_community(community_addr)
+                with self.metrics.busy("subscriber"), self.lease(community_addr) as leased:
+                    if leased and not self.db.is_subscribed(community_addr):
+                        self.subscribe_community(community_addr)
             except Exception:
                 logger.error(f"failed to subscribe community '{community_addr}'")
-            time.sleep(1)
+                self.sq.fail(community_addr)
+            else:
+                self.sq.done(community_addr)
 
 
 def main():
@@ -457,16 +2323,70 @@ def main():
         help='unsubscribes to specificed instances if `--instances="example instance" OR RESETS all subscriptions if `--instances=""` (CAUTION: USE WITH CARE)',
     )
     parser.add_argument(
-        "--database", default=os.environ.get("LEMMY_DATABASE"), help="database file to store database at"
+        "--database",
+        default=os.environ.get("LEMMY_DATABASE", "database.db"),
+        help="database file to store database at",
     )
     parser.add_argument("--domain", default=os.environ.get("LEMMY_DOMAIN"), help="lemmy instance")
     parser.add_argument("--username", default=os.environ.get("LEMMY_USERNAME"), help="lemmy username")
     parser.add_argument("--password", default=os.environ.get("LEMMY_PASSWORD"), help="lemmy password")
+    parser.add_argument(
+        "--targets",
+        default=os.environ.get("LEMMY_TARGETS"),
+        help="json file listing home instances to subscribe from a single crawl, instead of domain/username/password",
+    )
 
     parser.add_argument("--daemon", action="store_true", default=False)
-    parser.add_argument("--daemon-delay", type=int, default=86400, help="delay between executions in daemon mode")
+    parser.add_argument(
+        "--daemon-delay", type=int, default=86400, help="base delay between visits of an instance in daemon mode"
+    )
+    parser.add_argument("--min-revisit", type=int, default=3600, help="minimum delay between visits of an instance")
+    parser.add_argument("--max-revisit", type=int, default=604800, help="maximum delay between visits of an instance")
+    parser.add_argument("--crawl-workers", type=int, default=8, help="maximum number of instances crawled concurrently")
+    parser.add_argument(
+        "--crawl-host-workers", type=int, default=2, help="maximum number of concurrent requests per remote instance"
+    )
+
+    parser.add_argument("--resolve-workers", type=int, default=2, help="number of community resolver threads")
+    parser.add_argument("--subscribe-workers", type=int, default=2, help="number of community subscriber threads")
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=5.0,
+        help="maximum requests per second against home instance, shared by all nodes of a shard",
+    )
+    parser.add_argument(
+        "--discovery-workers", type=int, default=4, help="number of lemmyverse.net pages fetched concurrently"
+    )
+    parser.add_argument("--connect-timeout", type=float, default=5, help="seconds to wait for connections")
+    parser.add_argument("--read-timeout", type=float, default=15, help="seconds to wait for responses")
+    parser.add_argument(
+        "--full-crawl-interval",
+        type=int,
+        default=604800,
+        help="seconds between full crawls of an instance, incremental crawls in between (0 to disable)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=os.environ.get("LEMMY_METRICS_PORT"),
+        help="serve prometheus metrics on this port (requires prometheus_client)",
+    )
+    parser.add_argument(
+        "--no-sync",
+        dest="sync",
+        action="store_false",
+        default=True,
+        help="skip syncing known communities from home instance on startup",
+    )
 
     parser.add_argument("--lang-codes", type=str, help="comma-separated language codes (e.g. und, en, de)")
+    parser.add_argument(
+        "--lang-workers", type=int, default=4, help="maximum number of concurrent community language lookups"
+    )
+    parser.add_argument(
+        "--lang-cache-ttl", type=int, default=604800, help="seconds to cache instance and community languages"
+    )
     parser.add_argument(
         "--threshold-add",
         type=int,
@@ -492,9 +2412,41 @@ def main():
         default="!lemmygrad.ml,!exploding-heads.com,!lemmynsfw.com",
     )
 
+    parser.add_argument(
+        "--shard",
+        action="store_true",
+        default=False,
+        help="split instances between processes on this host sharing --database, with leases against duplicate work",
+    )
+    parser.add_argument(
+        "--node-id",
+        default=os.environ.get("LEMMY_NODE_ID", f"{socket.gethostname()}-{os.getpid()}"),
+        help="unique name of this node in sharded mode",
+    )
+    parser.add_argument("--profile", type=str, help="write timing spans of each cycle to this Chrome trace file")
+    parser.add_argument("--profile-cprofile", type=str, help="write cProfile statistics of each cycle to this file")
+    parser.add_argument("--record", type=str, help="crawl without subscribing, saving responses to a snapshot file")
+    parser.add_argument("--replay", type=str, help="evaluate filters offline against a snapshot file")
+    parser.add_argument(
+        "--plan", type=str, default="plan.json", help="file to write resolve/subscribe plan of --record or --replay"
+    )
+
     args = parser.parse_args()
-    if not args.domain or not args.username or not args.password:
-        exit(parser.print_usage())
+    offline = args.record is not None or args.replay is not None
+
+    # Home instance targets, each with its own credentials, thresholds and database
+    targets = [{"domain": args.domain, "username": args.username, "password": args.password, "database": args.database}]
+    if args.targets:
+        with open(args.targets) as f:
+            targets = json.load(f)
+        for target in targets:
+            name = f"database-{target.get('username')}@{target.get('domain')}.db"
+            target.setdefault("database", os.path.join(os.path.dirname(args.database), name))
+    for target in targets:
+        target.setdefault("threshold_add", args.threshold_add)
+        target.setdefault("threshold_subscribe", args.threshold_subscribe)
+        if not offline and (not target.get("domain") or not target.get("username") or not target.get("password")):
+            exit(parser.print_usage())
 
     # Verbosity configuration
     if args.verbose == 1:
@@ -521,26 +2473,84 @@ def main():
 
     # Create bot
     bot = Bot(
-        domain=args.domain,
-        username=args.username,
-        password=args.password,
-        threshold_resolve=args.threshold_add,
-        threshold_subscribe=args.threshold_subscribe,
+        domain=targets[0]["domain"],
+        username=targets[0]["username"],
+        password=targets[0]["password"],
+        threshold_resolve=targets[0]["threshold_add"],
+        threshold_subscribe=targets[0]["threshold_subscribe"],
         daemon=args.daemon,
         daemon_delay=args.daemon_delay,
         only_instances=only_instances,
         bad_instances=bad_instances,
         nsfw=args.nsfw,
         lang_codes=args.lang_codes,
+        database=":memory:" if offline else targets[0]["database"],
+        crawl_workers=args.crawl_workers,
+        crawl_host_workers=args.crawl_host_workers,
+        sync=args.sync,
+        lang_workers=args.lang_workers,
+        lang_cache_ttl=args.lang_cache_ttl,
+        resolve_workers=args.resolve_workers,
+        subscribe_workers=args.subscribe_workers,
+        rate_limit=args.rate_limit,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        full_crawl_interval=0 if offline else args.full_crawl_interval,
+        min_revisit=args.min_revisit,
+        max_revisit=args.max_revisit,
+        discovery_workers=args.discovery_workers,
+        metrics_port=args.metrics_port,
+        node_id=args.node_id if args.shard and not offline else None,
+        profile=args.profile,
+        profile_cprofile=args.profile_cprofile,
     )
 
-    if args.reset:
+    # Fan out to further targets, sharing the crawl of the first one
+    for target in targets[1:]:
+        bot.add_target(Bot(
+            domain=target["domain"],
+            username=target["username"],
+            password=target["password"],
+            threshold_resolve=target["threshold_add"],
+            threshold_subscribe=target["threshold_subscribe"],
+            daemon=args.daemon,
+            daemon_delay=args.daemon_delay,
+            only_instances=only_instances,
+            bad_instances=bad_instances,
+            nsfw=args.nsfw,
+            lang_codes=args.lang_codes,
+            database=":memory:" if offline else target["database"],
+            sync=args.sync,
+            resolve_workers=args.resolve_workers,
+            subscribe_workers=args.subscribe_workers,
+            rate_limit=args.rate_limit,
+            connect_timeout=args.connect_timeout,
+            read_timeout=args.read_timeout,
+            metrics=bot.metrics,
+            node_id=bot.shard.node if bot.shard is not None else None,
+            tracer=bot.tracer,
+        ))
+
+    if offline:
+        # Record or replay snapshot, and write plan
+        plan = bot.record(args.record) if args.record is not None else bot.replay(args.replay)
+        with open(args.plan, "w") as f:
+            json.dump(plan, f, indent=2)
+        plans = plan.values() if len(bot.targets) > 1 else [plan]
+        subscribe = sum(len(p["subscribe"]) for p in plans)
+        resolve = sum(len(p["resolve"]) for p in plans)
+        logger.success(f"planned {subscribe} subscriptions and {resolve} resolves to '{args.plan}'")
+    elif args.reset:
         # Reset?
-        bot.reset()
+        for target in bot.targets:
+            target.reset()
     else:
         # Start bot
         bot.start()
 
+    # Write trace of last cycle
+    bot.tracer.flush()
+
 
 if __name__ == "__main__":
     main()